@@ -0,0 +1,105 @@
+import numpy as np
+import pandas as pd
+
+
+def long_short_positions(predictions):
+    """
+    Positions of the two strategies of Market.ipynb from up/down predictions: long if the model predicts an up
+    move and flat otherwise, and long if it predicts an up move and short otherwise
+
+    Parameters:
+        predictions: pandas DataFrame
+            1 for predicted up moves, 0 otherwise, one row per model and one column per day
+    Returns:
+        pandas DataFrame
+            Positions, with rows '<model> Long' and '<model> Short' for each model
+    """
+    long = predictions.rename(index='{} Long'.format)
+    short = (2 * predictions - 1).rename(index='{} Short'.format)
+
+    return pd.concat([long, short])
+
+
+def segment_sharpe(strategy_returns, starts):
+    """
+    Annualized Sharpe ratio, sqrt(252) * mean / standard deviation, of each strategy over contiguous segments of
+    days. The standard deviation has 1 degree of freedom like pandas, and NaN returns are skipped
+
+    Parameters:
+        strategy_returns: array
+            Daily returns of each strategy, of shape (strategies, days)
+        starts: array
+            Increasing positions of the first day of each segment, starting with 0
+    Returns:
+        array
+            Shape (strategies, segments)
+    """
+    starts = np.asarray(starts)
+    if len(starts) == 0 or starts[0] != 0 or np.any(np.diff(starts) <= 0) or starts[-1] >= strategy_returns.shape[1]:
+        raise ValueError("starts must be increasing positions of days starting with 0")
+    valid = ~np.isnan(strategy_returns)
+    values = np.where(valid, strategy_returns, 0)
+    counts = np.add.reduceat(valid, starts, axis=1)
+    lengths = np.diff(np.append(starts, strategy_returns.shape[1]))
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = np.add.reduceat(values, starts, axis=1) / counts
+        # Deviations from the mean of each day's segment, so the variance doesn't lose precision
+        deviations = np.where(valid, values - np.repeat(means, lengths, axis=1), 0)
+        std = np.sqrt(np.add.reduceat(deviations ** 2, starts, axis=1) / (counts - 1))
+
+        return np.sqrt(252) * means / std
+
+
+def backtest(positions, returns, fold_starts=None):
+    """
+    Backtest of many strategies at once. Strategy returns are positions * returns, and every statistic is
+    computed for all strategies with array operations instead of a loop over strategies
+
+    Parameters:
+        positions: pandas DataFrame or array
+            Position of each strategy on each day, of shape (strategies, days). 1 is long, 0 flat, -1 short
+        returns: pandas Series or array
+            Return of the market on each day
+        fold_starts: array, optional
+            Increasing positions of the first day of each fold. If given, the Sharpe ratio of each fold is also
+            computed, and the last fold is the test set. Days before the first fold aren't in any statistic, like
+            the stats of Market.ipynb start at fold_0_ind
+    Returns:
+        pandas DataFrame, pandas DataFrame
+            Stats of each strategy: Accuracy and F1 of being long on up days, Sharpe over all days and share
+            of Days Long. And the Sharpe of each strategy in each fold, None if fold_starts isn't given
+    """
+    index = positions.index if isinstance(positions, pd.DataFrame) else None
+    positions = np.atleast_2d(np.asarray(positions, dtype=np.float64))
+    returns = np.asarray(returns, dtype=np.float64)
+    if fold_starts is not None:
+        fold_starts = np.asarray(fold_starts)
+        if len(fold_starts) == 0 or fold_starts[0] < 0 or np.any(np.diff(fold_starts) <= 0) or \
+                fold_starts[-1] >= len(returns):
+            raise ValueError("fold_starts must be increasing positions of days of returns")
+        positions = positions[:, fold_starts[0]:]
+        returns = returns[fold_starts[0]:]
+        fold_starts = fold_starts - fold_starts[0]
+    strategy_returns = positions * returns
+
+    # Being long is the prediction of an up move
+    up = returns > 0
+    long = positions > 0
+    true_positives = (long & up).sum(axis=1)
+    n_long = long.sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        f1 = np.nan_to_num(2 * true_positives / (n_long + up.sum()))
+
+    stats = pd.DataFrame(index=index)
+    stats['Accuracy'] = (long == up).mean(axis=1)
+    stats['F1'] = f1
+    stats['Sharpe'] = segment_sharpe(strategy_returns, np.array([0]))[:, 0]
+    stats['Days Long'] = n_long / positions.shape[1]
+
+    fold_sharpe = None
+    if fold_starts is not None:
+        fold_sharpe = pd.DataFrame(segment_sharpe(strategy_returns, fold_starts), index=index)
+        fold_sharpe.columns.name = 'fold'
+
+    return stats, fold_sharpe
@@ -0,0 +1,446 @@
+from .tweet_data import REGEX_DICT, clean_sentiment
+from .topics import TopicSeries, load_compact
+from .spacy import get_nlp, DEFAULT_MODEL as DEFAULT_SPACY_MODEL
+from .sentiment import SentimentScorer, DEFAULT_MODEL
+from .features import build_sentiment_features
+from .market import MODELS, walk_forward_search
+from .backtest import backtest
+
+from sklearn.ensemble import RandomForestClassifier, GradientBoostingClassifier
+from sklearn.model_selection import TimeSeriesSplit
+from sklearn.metrics import log_loss, roc_auc_score, accuracy_score, f1_score
+
+import numpy as np
+import pandas as pd
+
+import itertools
+import pickle
+import re
+import os
+import sys
+import time
+import subprocess
+
+
+def benchmark_clean_sentiment(tweets, n_jobs=None):
+    """
+    Compare the speed of clean_sentiment() with the previous implementation, one Series.apply(re.sub)
+    pass per REGEX_DICT entry, and check that both outputs are identical
+
+    Parameters:
+        tweets: pandas Series[str]
+            Series of raw tweets
+        n_jobs: int, optional
+            Number of worker processes for clean_sentiment(). Defaults to the number of CPUs
+    Returns:
+        dict
+            Tweets per second for the previous and current implementation
+    """
+
+    t = time.time()
+    expected = tweets
+    for value in REGEX_DICT.values():
+        expected = expected.apply(lambda tweet: re.sub(value, '', tweet))
+    expected = expected.str.lower()
+    before = len(tweets) / (time.time() - t)
+
+    t = time.time()
+    result = clean_sentiment(tweets, n_jobs=n_jobs)
+    after = len(tweets) / (time.time() - t)
+
+    assert result.equals(expected), "clean_sentiment output differs from the previous implementation"
+
+    print("Before: {:.0f} tweets/sec, after: {:.0f} tweets/sec".format(before, after))
+
+    return {'before': before, 'after': after}
+
+
+def benchmark_import(module='modules.topics', model=DEFAULT_SPACY_MODEL):
+    """
+    Compare the time and peak memory of importing a module in a fresh Python process with the previous
+    behaviour, where importing modules.topics also loaded the Spacy model. The previous import is reproduced by
+    importing the module and loading the model with spacy_twitter_model(), as the module level code used to do
+
+    Parameters:
+        module: str, optional
+            Module to import
+        model: str, optional
+            Spacy model loaded at import time before
+    Returns:
+        dict
+            Seconds and peak RSS in MB 'before' and 'after', and the speedup of the import
+    """
+    # ru_maxrss keeps the peak of the parent process across exec on Linux, so VmHWM is read when available
+    code = """
+import resource, time
+t = time.time()
+import {module}
+{load}
+seconds = time.time() - t
+try:
+    with open('/proc/self/status') as f:
+        rss_mb = [int(line.split()[1]) for line in f if line.startswith('VmHWM')][0] / 1024
+except OSError:
+    rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+print(seconds, rss_mb)
+"""
+    repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+    results = {}
+    for name, load in [('before', 'from modules.spacy import spacy_twitter_model; spacy_twitter_model({!r})'
+                        .format(model)),
+                       ('after', '')]:
+        output = subprocess.run([sys.executable, '-c', code.format(module=module, load=load)], cwd=repo_dir,
+                                capture_output=True, text=True, check=True).stdout.split()
+        results[name] = {'seconds': float(output[0]), 'rss_mb': float(output[1])}
+        print("{}: {:.2f} s, {:.0f} MB peak RSS".format(name.capitalize(), results[name]['seconds'],
+                                                        results[name]['rss_mb']))
+    results['speedup'] = results['before']['seconds'] / results['after']['seconds']
+    print("Speedup: {:.1f}x".format(results['speedup']))
+
+    return results
+
+
+def benchmark_tokenizer(tweets, nlp=None):
+    """
+    Compare the speed of TopicSeries.array_tokenizer() with TopicSeries.twitter_tokenizer() on the same Docs,
+    and check that both return the same tokens for every combination of tokenizer flags
+
+    Parameters:
+        tweets: list or pandas Series[str]
+            Sample of tweets
+        nlp: Spacy model, optional
+            Defaults to modules.spacy.get_nlp()
+    Returns:
+        dict
+            Tokens per second of twitter_tokenizer() and array_tokenizer() with default flags
+    """
+    nlp = nlp or get_nlp()
+    docs = list(nlp.pipe(tweets, disable=["tagger", "parser", "ner"]))
+    n_tokens = sum(len(doc) for doc in docs)
+
+    flag_names = ['urls', 'stop_words', 'lowercase', 'alpha_only', 'hashtags', 'lemma']
+    for values in itertools.product([True, False], repeat=len(flag_names)):
+        flags = dict(zip(flag_names, values))
+        for doc in docs:
+            assert TopicSeries.array_tokenizer(doc, **flags) == TopicSeries.twitter_tokenizer(doc, **flags), \
+                "array_tokenizer differs from twitter_tokenizer with {} for: {}".format(flags, doc.text)
+
+    results = {}
+    for name, tokenizer in [('twitter_tokenizer', TopicSeries.twitter_tokenizer),
+                            ('array_tokenizer', TopicSeries.array_tokenizer)]:
+        t = time.time()
+        for doc in docs:
+            tokenizer(doc)
+        results[name] = n_tokens / (time.time() - t)
+        print("{}: {:.0f} tokens/sec".format(name, results[name]))
+
+    return results
+
+
+def benchmark_compact(ts, df, date_range, directory='data/topics'):
+    """
+    Compare opening a series saved with TopicSeries.save() and with TopicSeries.save_compact(), and check
+    that the reconstruction errors of the opened series are the same as the original's. The opened series
+    is then saved back to its own directory, as when days are appended to it, and checked again
+
+    Parameters:
+        ts: TopicSeries
+            Fitted series
+        df: Pandas DataFrame or str
+            Output of read_raw_data() method in modules.tweet_data, or path to a tweet store
+        date_range: DatetimeIndex
+            Dates of the series whose reconstruction errors are compared
+        directory: string, optional
+            Directory of the compact series. The pickle is written next to it
+    Returns:
+        dict
+            Seconds to open the pickle and the compact series
+    """
+    expected = np.array(ts.calc_rec_error(df, date_range))
+
+    pickle_path = directory.rstrip(os.sep) + '.p'
+    ts.save(pickle_path)
+    t = time.time()
+    with open(pickle_path, 'rb') as f:
+        pickle.load(f)
+    before = time.time() - t
+    os.remove(pickle_path)
+
+    ts.save_compact(directory)
+    t = time.time()
+    compact = load_compact(directory)
+    after = time.time() - t
+
+    result = np.array(compact.calc_rec_error(df, date_range))
+    assert np.allclose(result, expected, rtol=1e-5), "Reconstruction errors differ after load_compact"
+
+    # Arrays of the opened series are memory mapped from the directory it is saved to
+    compact.save_compact(directory)
+    result = np.array(load_compact(directory).calc_rec_error(df, date_range))
+    assert np.allclose(result, expected, rtol=1e-5), "Reconstruction errors differ after saving to the same directory"
+
+    print("\nPickle: {:.3f} s, compact: {:.3f} s".format(before, after))
+
+    return {'before': before, 'after': after}
+
+
+def benchmark_sentiment_scaling(tweets, scorer=None, max_jobs=None):
+    """
+    Measure the throughput of SentimentScorer with 1, 2, 4, ... up to max_jobs worker processes, and check that
+    every run returns the same scores as a single process with the same number of threads
+
+    Parameters:
+        tweets: pandas Series[str]
+            Sample of cleaned tweets, output of clean_sentiment() in modules.tweet_data
+        scorer: SentimentScorer, optional
+            Scorer to benchmark, without a cache. Defaults to SentimentScorer()
+        max_jobs: int, optional
+            Largest number of worker processes. Defaults to the number of CPUs
+    Returns:
+        dict
+            Tweets per second for each number of worker processes
+    """
+    scorer = scorer or SentimentScorer()
+    max_jobs = max_jobs or os.cpu_count()
+    n_jobs, n_threads = scorer.n_jobs, scorer.n_threads
+
+    results = {}
+    # Scores of a single process by number of threads, which changes how float sums are split
+    expected = {}
+    for jobs in sorted({min(2 ** i, max_jobs) for i in range(max_jobs.bit_length() + 1)}):
+        # Each run uses all cores, split between the worker processes
+        threads = max(1, os.cpu_count() // jobs)
+        if threads not in expected:
+            scorer.n_jobs, scorer.n_threads = 1, threads
+            expected[threads] = scorer.score(tweets)
+        scorer.n_jobs, scorer.n_threads = jobs, threads
+        result = scorer.score(tweets)
+        assert result.equals(expected[threads]), \
+            "Scores with {} workers differ from a single process with {} threads".format(jobs, threads)
+        results[jobs] = scorer.stats['tweets_per_sec']
+        print("{} workers: {:.0f} tweets/sec".format(jobs, results[jobs]))
+
+    scorer.close()
+    scorer.n_jobs, scorer.n_threads = n_jobs, n_threads
+
+    return results
+
+
+def benchmark_quantization(tweets, date_range=None, model=DEFAULT_MODEL, tokenizer=None):
+    """
+    Compare the int8 quantized sentiment model with the full precision model on a sample of tweets: speed,
+    agreement of labels, differences in scores and, if date_range is given, differences in daily_average
+
+    Parameters:
+        tweets: pandas Series[str]
+            Held out sample of cleaned tweets, output of clean_sentiment() in modules.tweet_data, indexed by
+            timestamp if date_range is given
+        date_range: DateTimeIndex, optional
+            Dates whose intervals are the trading days of daily_average, as in Sentiment.ipynb
+        model: string or transformers model, optional
+            Model passed to SentimentScorer
+        tokenizer: string or transformers tokenizer, optional
+            Tokenizer passed to SentimentScorer
+    Returns:
+        dict
+            Speedup, share of equal labels, mean and max absolute difference of score and of
+            sentiment * score, and of daily_average if date_range is given
+    """
+    results = {}
+    scores = {}
+    for name, quantize in [('float', False), ('int8', True)]:
+        scorer = SentimentScorer(model, tokenizer, quantize=quantize)
+        scores[name] = scorer.score(tweets)
+        results['{}_tweets_per_sec'.format(name)] = scorer.stats['tweets_per_sec']
+    results['speedup'] = results['int8_tweets_per_sec'] / results['float_tweets_per_sec']
+
+    expected, result = scores['float'], scores['int8']
+    results['label_agreement'] = (expected.sentiment == result.sentiment).mean()
+    score_diff = (expected.score - result.score).abs()
+    results['score_mean_abs_diff'], results['score_max_abs_diff'] = score_diff.mean(), score_diff.max()
+    # Signed score is the per tweet input of daily_average
+    signed_diff = (expected.sentiment * expected.score - result.sentiment * result.score).abs()
+    results['signed_score_mean_abs_diff'], results['signed_score_max_abs_diff'] = signed_diff.mean(), signed_diff.max()
+
+    if date_range is not None:
+        date_bins = pd.cut(tweets.index, bins=date_range)
+        daily_diff = ((expected.sentiment * expected.score).groupby(date_bins, observed=False).mean() -
+                      (result.sentiment * result.score).groupby(date_bins, observed=False).mean()).abs()
+        results['daily_average_mean_abs_diff'], results['daily_average_max_abs_diff'] = daily_diff.mean(), \
+            daily_diff.max()
+
+    for key, value in results.items():
+        print("{}: {:.4f}".format(key, value))
+
+    return results
+
+
+def benchmark_sentiment_features(sentiment, handle_class, date_range):
+    """
+    Compare the speed of build_sentiment_features() with the groupby.apply construction of Sentiment.ipynb,
+    and check that both give the same columns and values
+
+    Parameters:
+        sentiment: pandas DataFrame
+            Scored tweets with 'handle', 'sentiment' and 'score' columns, indexed by timestamp
+        handle_class: pandas DataFrame
+            data/handle_class.csv
+        date_range: DatetimeIndex
+            Dates whose intervals are the trading days
+    Returns:
+        dict
+            Seconds of the previous and current implementation
+    """
+    def final_score(x):
+        return (x.sentiment * x.score).mean()
+
+    t = time.time()
+    merged = sentiment.reset_index().merge(handle_class[['class', 'handle', 'subclass']], on='handle')
+    merged = merged.set_index(sentiment.index.name or 'index')
+    expected = pd.DataFrame(index=date_range[1:])
+    date_bins = pd.cut(merged.index, bins=date_range)
+    expected['daily_average'] = merged.groupby(date_bins, observed=False).apply(final_score).values
+    class_averages = merged.groupby([date_bins, 'class'], observed=False).apply(final_score).unstack()
+    for name in class_averages.columns:
+        expected['daily_average_{}'.format(name)] = class_averages[name].values
+    trader = merged[merged.subclass == 'trader']
+    expected['daily_average_trader'] = trader.groupby(pd.cut(trader.index, bins=date_range),
+                                                      observed=False).apply(final_score).values
+    A = pd.DataFrame(index=date_range[1:])
+    A['avg'] = merged.groupby(date_bins, observed=False).tweet_id.count().values
+    A['day_diff'] = 0
+    A.loc[A.index[1:], 'day_diff'] = (A.index[1:] - A.index[:-1]).days
+    for i in [2, 3, 4, 5]:
+        ratio = A[A.day_diff == 1].mean() / A[A.day_diff == i].mean()
+        A.loc[A.day_diff == i, 'avg'] = (ratio['avg'] * A[A.day_diff == i]['avg']).astype('int')
+    A = A / A.rolling(200, min_periods=1).mean()
+    expected['num_tweets'] = A.avg
+    expected.iloc[0:7, expected.columns.get_loc('num_tweets')] = 1
+    expected.loc[expected.num_tweets < 0.8, 'num_tweets'] = 0.8
+    expected_users = merged.groupby([date_bins, 'handle'], observed=False).apply(final_score).unstack()
+    before = time.time() - t
+
+    t = time.time()
+    result, users = build_sentiment_features(sentiment, handle_class, date_range)
+    after = time.time() - t
+
+    assert list(result.columns) == list(expected.columns), "Columns differ: {}".format(list(result.columns))
+    assert np.allclose(result.values, expected.values, rtol=1e-12, atol=1e-15, equal_nan=True), \
+        "Sentiment features differ from the previous implementation"
+    assert list(users.columns) == list(expected_users.columns), "Handles differ"
+    assert np.allclose(users.values, expected_users.values, rtol=1e-12, atol=1e-15, equal_nan=True), \
+        "User features differ from the previous implementation"
+
+    print("Before: {:.2f} s, after: {:.2f} s".format(before, after))
+
+    return {'before': before, 'after': after}
+
+
+def benchmark_walk_forward(X, y, max_depths=range(6, 21), n_jobs=None):
+    """
+    Compare the speed of walk_forward_search() in modules.market with the serial grid search loop of
+    Market.ipynb, and check that both give the same logloss and rocauc tables
+
+    Parameters:
+        X: pandas DataFrame
+            Features
+        y: pandas Series
+            1 if the market went up, 0 otherwise
+        max_depths: iterable of int, optional
+            Values of max_depth
+        n_jobs: int, optional
+            Number of worker processes for walk_forward_search(). Defaults to the number of CPUs
+    Returns:
+        dict
+            Seconds of the previous and current implementation
+    """
+    max_depths = list(max_depths)
+
+    t = time.time()
+    tscv = TimeSeriesSplit(n_splits=5)
+    expected_logloss = pd.DataFrame(index=max_depths, columns=MODELS, dtype=np.float64)
+    expected_rocauc = pd.DataFrame(index=max_depths, columns=MODELS, dtype=np.float64)
+    for max_depth in max_depths:
+        rf_logloss, rf_rocauc, boost_logloss, boost_rocauc = [], [], [], []
+        for train_index, test_index in tscv.split(X):
+            X_train, X_test = X.iloc[train_index], X.iloc[test_index]
+            y_train, y_test = y.iloc[train_index], y.iloc[test_index]
+            for clf, fold_logloss, fold_rocauc in [
+                    (RandomForestClassifier(max_depth=max_depth, criterion='entropy', random_state=42),
+                     rf_logloss, rf_rocauc),
+                    (GradientBoostingClassifier(max_depth=max_depth, random_state=42), boost_logloss,
+                     boost_rocauc)]:
+                clf.fit(X_train, y_train)
+                pred = clf.predict(X_test)
+                fold_logloss.append(log_loss(pred, y_test, labels=[0, 1]))
+                fold_rocauc.append(roc_auc_score(pred, y_test) if len(np.unique(pred)) > 1 else np.nan)
+        expected_logloss.loc[max_depth] = [np.mean(rf_logloss), np.mean(boost_logloss)]
+        expected_rocauc.loc[max_depth] = [np.mean(rf_rocauc), np.mean(boost_rocauc)]
+    before = time.time() - t
+
+    t = time.time()
+    logloss, rocauc = walk_forward_search(X, y, max_depths, n_jobs=n_jobs)
+    after = time.time() - t
+
+    assert list(logloss.index) == max_depths and list(rocauc.index) == max_depths, "Tables aren't indexed by max_depth"
+    assert np.allclose(logloss.values, expected_logloss.values, equal_nan=True), \
+        "logloss differs from the serial grid search"
+    assert np.allclose(rocauc.values, expected_rocauc.values, equal_nan=True), \
+        "rocauc differs from the serial grid search"
+
+    print("Before: {:.2f} s, after: {:.2f} s".format(before, after))
+
+    return {'before': before, 'after': after}
+
+
+def benchmark_backtest(positions, returns, fold_starts):
+    """
+    Compare the speed of backtest() in modules.backtest with computing the same stats one strategy at a time
+    with sharpe_ratio() of Market.ipynb and sklearn metrics, and check that both give the same values
+
+    Parameters:
+        positions: pandas DataFrame
+            Position of each strategy on each day, of shape (strategies, days)
+        returns: pandas Series
+            Return of the market on each day
+        fold_starts: array
+            Increasing positions of the first day of each fold. Days before the first fold are left out
+    Returns:
+        dict
+            Seconds of the previous and current implementation
+    """
+    def sharpe_ratio(pos, ret):
+        return np.sqrt(252) * (pos * ret).mean() / (pos * ret).std()
+
+    t = time.time()
+    # Stats start at the first fold, like fold_0_ind in Market.ipynb
+    first = fold_starts[0]
+    positions_full, returns_full = positions, returns
+    positions = positions.iloc[:, first:]
+    returns = returns.iloc[first:]
+    y = 1 * (returns > 0)
+    bounds = [start - first for start in fold_starts] + [len(returns)]
+    expected = pd.DataFrame(index=positions.index, columns=['Accuracy', 'F1', 'Sharpe', 'Days Long'],
+                            dtype=np.float64)
+    expected_folds = pd.DataFrame(index=positions.index, columns=range(len(fold_starts)), dtype=np.float64)
+    for name, position in positions.iterrows():
+        position = pd.Series(position.values, index=returns.index)
+        long = 1 * (position > 0)
+        expected.loc[name] = [accuracy_score(long, y), f1_score(long, y, zero_division=0),
+                              sharpe_ratio(position, returns), long.sum() / len(long)]
+        expected_folds.loc[name] = [sharpe_ratio(position.iloc[start:end], returns.iloc[start:end])
+                                    for start, end in zip(bounds[:-1], bounds[1:])]
+    before = time.time() - t
+
+    t = time.time()
+    stats, fold_sharpe = backtest(positions_full, returns_full, fold_starts)
+    after = time.time() - t
+
+    assert np.allclose(stats.values, expected.values, equal_nan=True), "Stats differ from the per strategy loop"
+    assert np.allclose(fold_sharpe.values, expected_folds.values, equal_nan=True), \
+        "Fold Sharpe ratios differ from the per strategy loop"
+
+    print("Before: {:.2f} s, after: {:.2f} s".format(before, after))
+
+    return {'before': before, 'after': after}
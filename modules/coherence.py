@@ -0,0 +1,250 @@
+from .spacy import load_model
+from .topics import top_indices
+
+import numpy as np
+import pandas as pd
+
+import os
+
+# Spacy model with GloVe vectors used for topic coherence in Topic Modeling.ipynb
+COHERENCE_MODEL = 'en_core_web_md'
+
+
+class WordEmbeddings:
+    """
+    Word vectors of a topic vocabulary, stored so that the vector of any set of words can be computed without
+    running Spacy. For each word, the sum of the vectors of its tokens and its number of tokens are kept, so
+    the vector of a set of words is the same as the vector of a Spacy Doc of the words joined by spaces: the
+    mean over all tokens, with tokens without a vector counting as zeros
+    """
+    def __init__(self, words, sums, counts):
+        """
+        Parameters:
+            words: List[str]
+                Vocabulary
+            sums: array
+                Sum of the token vectors of each word, of shape (words, vector size)
+            counts: array
+                Number of tokens of each word
+        """
+        self.words = list(words)
+        self.sums = sums
+        self.counts = counts
+        self.vocab = {word: i for i, word in enumerate(self.words)}
+
+    @staticmethod
+    def build(words, nlp=None):
+        """
+        Look up the vectors of each word once with the Spacy tokenizer and vocabulary
+
+        Parameters:
+            words: iterable of str
+                Vocabulary
+            nlp: Spacy model, optional
+                Model with word vectors. Defaults to en_core_web_md
+        Returns:
+            WordEmbeddings
+        """
+        if nlp is None:
+            nlp = load_model(COHERENCE_MODEL)
+
+        words = list(words)
+        sums = np.zeros((len(words), nlp.vocab.vectors_length), dtype=np.float32)
+        counts = np.zeros(len(words), dtype=np.int32)
+        # Only the tokenizer is needed, vectors come from the vocabulary
+        for i, doc in enumerate(nlp.tokenizer.pipe(words)):
+            counts[i] = len(doc)
+            for token in doc:
+                if token.has_vector:
+                    sums[i] += token.vector
+
+        return WordEmbeddings(words, sums, counts)
+
+    @staticmethod
+    def from_topics(ts, top_display=20, nlp=None):
+        """
+        Embeddings of the words in the top words of any topic of a TopicSeries
+
+        Parameters:
+            ts: TopicSeries
+            top_display: int, optional
+                Number of top words per topic
+            nlp: Spacy model, optional
+                Model with word vectors. Defaults to en_core_web_md
+        Returns:
+            WordEmbeddings
+        """
+        words = set()
+        for date in ts.nmf_dict:
+            for topic_words in top_words(ts, date, top_display):
+                words.update(topic_words)
+
+        return WordEmbeddings.build(sorted(words), nlp)
+
+    def save(self, directory='data/embeddings'):
+        os.makedirs(directory, exist_ok=True)
+        np.save(os.path.join(directory, 'words.npy'), np.array(self.words, dtype=str))
+        np.save(os.path.join(directory, 'sums.npy'), self.sums)
+        np.save(os.path.join(directory, 'counts.npy'), self.counts)
+
+    @staticmethod
+    def load(directory='data/embeddings'):
+        """
+        Load embeddings written by save(), with the vectors memory mapped
+
+        Parameters:
+            directory: string, optional
+        Returns:
+            WordEmbeddings
+        """
+        return WordEmbeddings(np.load(os.path.join(directory, 'words.npy')).tolist(),
+                              np.load(os.path.join(directory, 'sums.npy'), mmap_mode='r'),
+                              np.load(os.path.join(directory, 'counts.npy'), mmap_mode='r'))
+
+    def ids(self, words):
+        """
+        Rows of words in the embeddings, -1 for words that aren't in the vocabulary
+        """
+        return np.array([self.vocab.get(word, -1) for word in words], dtype=np.int64)
+
+    def vectors(self, ids):
+        """
+        Vectors of sets of words, each the mean of the token vectors of its words
+
+        Parameters:
+            ids: array
+                Rows of the words of each set, output of ids(), with the words of a set along the last axis.
+                Words with id -1 are skipped
+        Returns:
+            array
+                One vector per set, of shape ids.shape[:-1] + (vector size,)
+        """
+        known = ids >= 0
+        rows = np.where(known, ids, 0)
+        sums = (np.asarray(self.sums[rows.ravel()], dtype=np.float64).reshape(ids.shape + (-1,)) *
+                known[..., np.newaxis]).sum(axis=-2)
+        counts = (self.counts[rows] * known).sum(axis=-1)
+
+        return sums / np.maximum(counts, 1)[..., np.newaxis]
+
+
+def top_words(ts, date, top_display=20):
+    """
+    Top words of each NMF topic of a day, by weight. Read from the top words index of ts if it has one with
+    enough words per topic
+
+    Parameters:
+        ts: TopicSeries
+        date: string
+            Date in 'yyyy-mm-dd' format
+        top_display: int, optional
+            Number of words per topic
+    Returns:
+        List[List[str]]
+    """
+    if _use_index(ts, [date], top_display):
+        return ts.top_index.top_words(date, top_display)
+
+    word_features = ts.get_feature_names(date)
+
+    return [[word_features[i] for i in topic if i >= 0]
+            for topic in top_indices(ts.nmf_dict[date].components_, top_display)]
+
+
+def _use_index(ts, dates, top_display):
+    index = ts.top_index
+    return index is not None and index.k >= top_display and all(date in index for date in dates)
+
+
+def _normalize(vectors):
+    # Zero vectors stay zero, so their cosine similarity with any vector is 0
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+def coherence_features(ts, embeddings=None, top_display=20, dates=None, batch_size=256):
+    """
+    topic_coherence and topic_coherence_diff features of Topic Modeling.ipynb for all days. The vector of a
+    topic is the mean vector of its top words, taken from embeddings instead of running Spacy on each topic.
+    topic_coherence of a day is the mean cosine similarity between its different topics, topic_coherence_diff
+    is the mean over the previous day's topics of their highest cosine similarity with a topic of the day.
+    Days are processed in batches with matrix operations
+
+    Parameters:
+        ts: TopicSeries
+        embeddings: WordEmbeddings, optional
+            Embeddings of the topic vocabulary. Defaults to WordEmbeddings.from_topics(ts, top_display)
+        top_display: int, optional
+            Number of top words per topic
+        dates: List[str], optional
+            Sorted dates to use. Defaults to all dates of ts
+        batch_size: int, optional
+            Number of days whose vectors are computed at once
+    Returns:
+        pandas DataFrame
+            topic_coherence and topic_coherence_diff, indexed by dates[1:]
+    """
+    dates = dates or sorted(ts.nmf_dict)
+    embeddings = embeddings or WordEmbeddings.from_topics(ts, top_display)
+
+    use_index = _use_index(ts, dates, top_display)
+    if use_index:
+        # Map the term ids of the index to rows of the embeddings, the last entry maps padding (-1) to -1
+        index = ts.top_index
+        lookup = np.append(embeddings.ids(index.words), -1)
+        positions = np.searchsorted(index.dates, dates)
+
+    vectors = []
+    for start in range(0, len(dates), batch_size):
+        if use_index:
+            ids = lookup[index.term_ids[positions[start:start + batch_size], :, :top_display]]
+            vectors.append(_normalize(embeddings.vectors(ids)))
+        else:
+            vectors.extend(topic_vectors(embeddings, top_words(ts, date, top_display))[np.newaxis]
+                           for date in dates[start:start + batch_size])
+    topic_coherence, topic_coherence_diff = coherence_scores(np.concatenate(vectors))
+
+    features = pd.DataFrame(index=pd.Index(dates[1:], name='Date'))
+    features['topic_coherence'] = topic_coherence
+    features['topic_coherence_diff'] = topic_coherence_diff
+
+    return features
+
+
+def topic_vectors(embeddings, words):
+    """
+    Normalized vectors of the topics of a day
+
+    Parameters:
+        embeddings: WordEmbeddings
+        words: List[List[str]]
+            Top words of each topic, output of top_words()
+    Returns:
+        array
+            Shape (topics, vector size)
+    """
+    top_display = max(len(topic_words) for topic_words in words)
+    ids = np.stack([np.pad(embeddings.ids(topic_words), (0, top_display - len(topic_words)), constant_values=-1)
+                    for topic_words in words])
+
+    return _normalize(embeddings.vectors(ids))
+
+
+def coherence_scores(vectors):
+    """
+    topic_coherence and topic_coherence_diff of consecutive days from normalized topic vectors
+
+    Parameters:
+        vectors: array
+            Normalized topic vectors of each day, of shape (days, topics, vector size)
+    Returns:
+        array, array
+            topic_coherence and topic_coherence_diff of each day but the first
+    """
+    n_topics = vectors.shape[1]
+    # Cosine similarities between the topics of each day, and between topics of consecutive days
+    within = np.einsum('dik,djk->dij', vectors[1:], vectors[1:])
+    across = np.einsum('dik,djk->dij', vectors[:-1], vectors[1:])
+
+    return (within.sum(axis=(1, 2)) - np.trace(within, axis1=1, axis2=2)) / (n_topics ** 2 - n_topics), \
+        across.max(axis=2).mean(axis=1)
@@ -0,0 +1,289 @@
+import numpy as np
+import pandas as pd
+
+import pickle
+
+
+def assign_days(timestamps, date_range):
+    """
+    Trading day of each timestamp. Day i is the interval (date_range[i], date_range[i + 1]], the same bins as
+    pd.cut(timestamps, bins=date_range)
+
+    Parameters:
+        timestamps: DatetimeIndex or array of datetime64
+            Timestamps of the tweets
+        date_range: DatetimeIndex
+            Sorted dates whose intervals are the trading days
+    Returns:
+        array
+            Position of the day of each timestamp in date_range[1:], -1 if it's outside date_range
+    """
+    edges = np.asarray(date_range, dtype='datetime64[ns]')
+    day = np.searchsorted(edges, np.asarray(timestamps, dtype='datetime64[ns]'), side='left') - 1
+    day[day >= len(edges) - 1] = -1
+
+    return day
+
+
+def group_sums(day, key, values, n_days, n_keys):
+    """
+    Sum and count of values by day and key, in one pass
+
+    Parameters:
+        day: array
+            Day of each value, output of assign_days(). Values with day -1 are ignored
+        key: array
+            Integer code of each value, in [0, n_keys). Values with key -1 are ignored
+        values: array
+            Values to sum
+        n_days: int
+            Number of days
+        n_keys: int
+            Number of keys
+    Returns:
+        array, array
+            Sums and counts, of shape (n_days, n_keys)
+    """
+    valid = (day >= 0) & (key >= 0)
+    group = day[valid] * n_keys + key[valid]
+    sums = np.bincount(group, weights=values[valid], minlength=n_days * n_keys).reshape(n_days, n_keys)
+    counts = np.bincount(group, minlength=n_days * n_keys).reshape(n_days, n_keys)
+
+    return sums, counts
+
+
+def _mean(sums, counts):
+    # NaN for days without tweets, like the mean of an empty group
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return sums / counts
+
+
+def num_tweets_ratio(counts, dates):
+    """
+    Number of tweets of each day divided by its 200 day moving average, as in Sentiment.ipynb. Days after a
+    weekend or holiday span several calendar days, so their counts are first scaled by the ratio between the
+    average count of 1 day intervals and the average count of intervals of the same length. The first 7 days
+    are set to 1 for the moving average burn in, and the ratio is capped from below at 0.8
+
+    Parameters:
+        counts: array
+            Number of tweets of each day
+        dates: DatetimeIndex
+            End of each day, date_range[1:]
+    Returns:
+        array
+    """
+    counts = np.asarray(counts, dtype=np.int64).copy()
+    day_diff = np.zeros(len(dates), dtype=np.int64)
+    day_diff[1:] = (dates[1:] - dates[:-1]).days
+    for i in [2, 3, 4, 5]:
+        selected = day_diff == i
+        ratio = counts[day_diff == 1].mean() / counts[selected].mean() if selected.any() else np.nan
+        counts[selected] = (ratio * counts[selected]).astype('int')
+
+    ratio = pd.Series(counts, dtype=np.float64)
+    ratio = (ratio / ratio.rolling(200, min_periods=1).mean()).to_numpy(copy=True)
+    ratio[0:7] = 1
+    ratio[ratio < 0.8] = 0.8
+
+    return ratio
+
+
+def build_sentiment_features(sentiment, handle_class, date_range):
+    """
+    Daily sentiment features of Sentiment.ipynb, data/sentiment_features.csv, and the per handle scores
+    (user_features), computed in one pass over the tweets. Tweets are assigned to days with a sorted search and
+    averages are sums and counts over integer codes of day, class and handle, instead of a groupby.apply for
+    each group. Only tweets of handles in handle_class are used, as with the merge in the notebook
+
+    Parameters:
+        sentiment: pandas DataFrame
+            Scored tweets with 'handle', 'sentiment' and 'score' columns, indexed by timestamp
+        handle_class: pandas DataFrame
+            data/handle_class.csv, with 'handle', 'class' and 'subclass' columns
+        date_range: DatetimeIndex
+            Dates whose intervals are the trading days
+    Returns:
+        pandas DataFrame, pandas DataFrame
+            Sentiment features with columns daily_average, daily_average_<class> for each class,
+            daily_average_trader and num_tweets, and the average score of each handle by day, both indexed by
+            date_range[1:]
+    """
+    aggregator = SentimentAggregator(handle_class, date_range)
+    aggregator.update(sentiment)
+
+    return aggregator.features(), aggregator.user_features()
+
+
+class SentimentAggregator:
+    """
+    Running sums and counts of sentiment * score by day, by day and class, by day for traders and by day and
+    handle. New scored tweets are folded into the sums of the days they fall on as they arrive, so updating the
+    averages costs the new tweets and their days instead of aggregating all tweets again.
+
+    num_tweets is global, as in Sentiment.ipynb: the day_diff scaling uses the average count of all days of each
+    interval length, and the 200 day moving average runs over the scaled counts. Every update changes that
+    scaling, so num_tweets is recomputed from the daily counts, a pass over the days but not the tweets, and
+    the num_tweets of most earlier days change with it
+    """
+    def __init__(self, handle_class, date_range):
+        """
+        Parameters:
+            handle_class: pandas DataFrame
+                data/handle_class.csv, with 'handle', 'class' and 'subclass' columns
+            date_range: DatetimeIndex
+                Dates whose intervals are the trading days, can be extended later by update()
+        """
+        handle_class = handle_class.drop_duplicates('handle').set_index('handle').sort_index()
+        self.handles = handle_class.index
+        # Codes of each handle's class and whether it's a trader, -1 if not
+        self.handle_classes, self.class_names = pd.factorize(handle_class['class'].values, sort=True)
+        self.handle_traders = np.where(handle_class.subclass.values == 'trader', 0, -1)
+        self.date_range = date_range
+
+        n_days = len(date_range) - 1
+        self.day_sums, self.day_counts = np.zeros(n_days), np.zeros(n_days, dtype=np.int64)
+        self.class_sums = np.zeros((n_days, len(self.class_names)))
+        self.class_counts = np.zeros((n_days, len(self.class_names)), dtype=np.int64)
+        self.trader_sums, self.trader_counts = np.zeros(n_days), np.zeros(n_days, dtype=np.int64)
+        self.handle_sums = np.zeros((n_days, len(self.handles)))
+        self.handle_counts = np.zeros((n_days, len(self.handles)), dtype=np.int64)
+
+    def _extend(self, date_range):
+        """
+        Add the new days of date_range, which must start with the current date_range
+        """
+        n_old = len(self.date_range)
+        if len(date_range) < n_old or not date_range[:n_old].equals(self.date_range):
+            raise ValueError("date_range must start with the current date_range of the aggregator")
+        n_new = len(date_range) - n_old
+        for name in ['day_sums', 'day_counts', 'class_sums', 'class_counts', 'trader_sums', 'trader_counts',
+                     'handle_sums', 'handle_counts']:
+            values = getattr(self, name)
+            setattr(self, name, np.concatenate([values, np.zeros((n_new,) + values.shape[1:], dtype=values.dtype)]))
+        self.date_range = date_range
+
+    def update(self, sentiment, date_range=None):
+        """
+        Fold newly scored tweets into the sums
+
+        Parameters:
+            sentiment: pandas DataFrame
+                Scored tweets with 'handle', 'sentiment' and 'score' columns, indexed by timestamp. Tweets
+                outside date_range are ignored
+            date_range: DatetimeIndex, optional
+                Current date_range extended with new trading days
+        Returns:
+            pandas DataFrame
+                Rows of features() that changed: days with new tweets, new days, and days whose num_tweets
+                changed. Since num_tweets is global, an update that adds a day usually changes the num_tweets
+                of nearly every day, and nearly all rows are returned
+        """
+        n_old = len(self.date_range) - 1
+        num_tweets_before = num_tweets_ratio(self.day_counts, self.date_range[1:])
+        if date_range is not None:
+            self._extend(date_range)
+
+        handle_pos = self.handles.get_indexer(sentiment.handle)
+        classified = handle_pos >= 0
+        day = assign_days(sentiment.index, self.date_range)
+        day[~classified] = -1
+        signed_score = (sentiment.sentiment.values * sentiment.score.values).astype(np.float64)
+        tweet_class = np.where(classified, self.handle_classes[handle_pos], -1)
+        tweet_trader = np.where(classified, self.handle_traders[handle_pos], -1)
+        tweet_handle = np.where(classified, handle_pos, -1)
+
+        # Sums are only computed for the days the new tweets fall on, then added to the rows of those days
+        days = np.unique(day[day >= 0])
+        day = np.where(day >= 0, np.searchsorted(days, day), -1)
+        sums, counts = group_sums(day, np.zeros(len(day), dtype=np.int64), signed_score, len(days), 1)
+        self.day_sums[days] += sums[:, 0]
+        self.day_counts[days] += counts[:, 0]
+        sums, counts = group_sums(day, tweet_class, signed_score, len(days), len(self.class_names))
+        self.class_sums[days] += sums
+        self.class_counts[days] += counts
+        sums, counts = group_sums(day, tweet_trader, signed_score, len(days), 1)
+        self.trader_sums[days] += sums[:, 0]
+        self.trader_counts[days] += counts[:, 0]
+        sums, counts = group_sums(day, tweet_handle, signed_score, len(days), len(self.handles))
+        self.handle_sums[days] += sums
+        self.handle_counts[days] += counts
+
+        num_tweets = num_tweets_ratio(self.day_counts, self.date_range[1:])
+        changed = np.zeros(len(num_tweets), dtype=bool)
+        changed[:n_old] = ~((num_tweets[:n_old] == num_tweets_before) |
+                            (np.isnan(num_tweets[:n_old]) & np.isnan(num_tweets_before)))
+        changed[n_old:] = True
+        changed[days] = True
+        rows = np.flatnonzero(changed)
+
+        return features_frame(self.date_range[1:][rows], self.day_sums[rows], self.day_counts[rows],
+                              self.class_sums[rows], self.class_counts[rows], self.class_names,
+                              self.trader_sums[rows], self.trader_counts[rows],
+                              observed=self.class_counts.any(axis=0), num_tweets=num_tweets[rows])
+
+    def features(self):
+        """
+        Sentiment features of all days, same as build_sentiment_features()
+
+        Returns:
+            pandas DataFrame
+        """
+        return features_frame(self.date_range[1:], self.day_sums, self.day_counts, self.class_sums,
+                              self.class_counts, self.class_names, self.trader_sums, self.trader_counts)
+
+    def user_features(self):
+        """
+        Average score of each handle with tweets by day, same as build_sentiment_features()
+
+        Returns:
+            pandas DataFrame
+        """
+        observed = self.handle_counts.any(axis=0)
+        return pd.DataFrame(_mean(self.handle_sums[:, observed], self.handle_counts[:, observed]),
+                            index=self.date_range[1:], columns=pd.Index(self.handles[observed], name='handle'))
+
+    def save(self, file_path='data/sentiment_aggregator.p'):
+
+        pickle.dump(self, open(file_path, "wb"))
+
+
+def features_frame(dates, day_sums, day_counts, class_sums, class_counts, class_names, trader_sums,
+                   trader_counts, observed=None, num_tweets=None):
+    """
+    Sentiment features DataFrame from sums and counts of signed scores by day
+
+    Parameters:
+        dates: DatetimeIndex
+            End of each day, date_range[1:]
+        day_sums, day_counts: array
+            Sum of sentiment * score and number of tweets of each day
+        class_sums, class_counts: array
+            Sum and number of tweets of each day and class, of shape (days, classes)
+        class_names: list
+            Sorted class names
+        trader_sums, trader_counts: array
+            Sum and number of tweets of traders of each day
+        observed: array, optional
+            Whether each class gets a column. Defaults to classes with tweets in class_counts, pass it when
+            dates are only some of the days
+        num_tweets: array, optional
+            num_tweets of each day. Defaults to num_tweets_ratio(day_counts, dates), which needs all days
+    Returns:
+        pandas DataFrame
+    """
+    if observed is None:
+        observed = class_counts.any(axis=0)
+    if num_tweets is None:
+        num_tweets = num_tweets_ratio(day_counts, dates)
+
+    features = pd.DataFrame(index=dates)
+    features['daily_average'] = _mean(day_sums, day_counts)
+    for i, name in enumerate(class_names):
+        # Classes without any tweet don't get a column, like the unstack in the notebook
+        if observed[i]:
+            features['daily_average_{}'.format(name)] = _mean(class_sums[:, i], class_counts[:, i])
+    features['daily_average_trader'] = _mean(trader_sums, trader_counts)
+    features['num_tweets'] = num_tweets
+
+    return features
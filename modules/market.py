@@ -0,0 +1,154 @@
+from sklearn.ensemble import RandomForestClassifier, GradientBoostingClassifier
+from sklearn.model_selection import TimeSeriesSplit
+from sklearn.metrics import log_loss, roc_auc_score
+import numpy as np
+import pandas as pd
+
+import itertools
+import multiprocessing
+import os
+
+MODELS = ['rf', 'boost']
+
+
+def make_model(name, max_depth, n_estimators=100):
+    """
+    Classifiers of Market.ipynb
+
+    Parameters:
+        name: string
+            'rf' for RandomForestClassifier, 'boost' for GradientBoostingClassifier
+        max_depth: int
+            Maximum depth of the trees
+        n_estimators: int, optional
+            Number of trees
+    Returns:
+        Sklearn classifier, with warm_start so more trees can be added to it
+    """
+    if name == 'rf':
+        return RandomForestClassifier(n_estimators=n_estimators, max_depth=max_depth, criterion='entropy',
+                                      random_state=42, warm_start=True)
+    return GradientBoostingClassifier(n_estimators=n_estimators, max_depth=max_depth, random_state=42,
+                                      warm_start=True)
+
+
+def walk_forward_folds(X, y, n_splits=5):
+    """
+    Train and test arrays of each TimeSeriesSplit fold, sliced once as contiguous float32 arrays, which is the
+    dtype the tree models fit on
+
+    Parameters:
+        X: pandas DataFrame
+            Features
+        y: pandas Series
+            1 if the market went up, 0 otherwise
+        n_splits: int, optional
+            Number of folds
+    Returns:
+        List[tuple]
+            (X_train, X_test, y_train, y_test) of each fold
+    """
+    X_values = np.asarray(X, dtype=np.float32)
+    y_values = np.asarray(y)
+
+    return [(np.ascontiguousarray(X_values[train_index]), np.ascontiguousarray(X_values[test_index]),
+             y_values[train_index], y_values[test_index])
+            for train_index, test_index in TimeSeriesSplit(n_splits=n_splits).split(X_values)]
+
+
+def _fold_scores(pred, y_test):
+    # Same argument order as Market.ipynb. ROC AUC isn't defined if the model predicts only one class
+    rocauc = roc_auc_score(pred, y_test) if len(np.unique(pred)) > 1 else np.nan
+    return log_loss(pred, y_test, labels=[0, 1]), rocauc
+
+
+def _fit_fold(folds, name, max_depth, fold, n_estimators):
+    """
+    Fit a model on a fold, growing it through each number of trees of n_estimators instead of fitting every
+    size from scratch
+
+    Returns:
+        List[tuple]
+            (n_estimators, logloss, rocauc) for each number of trees
+    """
+    X_train, X_test, y_train, y_test = folds[fold]
+    clf = make_model(name, max_depth, n_estimators[0])
+    scores = []
+    for n in n_estimators:
+        clf.set_params(n_estimators=n)
+        clf.fit(X_train, y_train)
+        scores.append((n,) + _fold_scores(clf.predict(X_test), y_test))
+
+    return scores
+
+
+def walk_forward_search(X, y, max_depths=range(6, 21), n_estimators=(100,), n_splits=5, n_jobs=None):
+    """
+    Walk forward search of Market.ipynb: for each max_depth and number of trees, mean logloss and rocauc of
+    RandomForestClassifier and GradientBoostingClassifier over the TimeSeriesSplit folds. Every combination
+    of model, max_depth and fold is fitted in parallel, and numbers of trees are reached by adding trees to the
+    same model. Results are the same as fitting each combination separately.
+
+    The notebook raises when a model predicts only one class on a fold, since ROC AUC isn't defined. Here the
+    rocauc of that fold is NaN instead, so the mean rocauc of that model and max_depth is NaN, and the search
+    goes on with the other combinations
+
+    Parameters:
+        X: pandas DataFrame
+            Features
+        y: pandas Series
+            1 if the market went up, 0 otherwise
+        max_depths: iterable of int, optional
+            Values of max_depth
+        n_estimators: iterable of int, optional
+            Numbers of trees. Defaults to 100, the default of both models
+        n_splits: int, optional
+            Number of folds
+        n_jobs: int, optional
+            Number of worker processes. If None, uses the number of CPUs
+    Returns:
+        pandas DataFrame, pandas DataFrame
+            logloss and rocauc, with columns 'rf' and 'boost', indexed by max_depth like the tables of the
+            notebook. If several n_estimators are given, indexed by (n_estimators, max_depth)
+    """
+    max_depths = list(max_depths)
+    n_estimators = sorted(n_estimators)
+    folds = walk_forward_folds(X, y, n_splits)
+    tasks = list(itertools.product(MODELS, max_depths, range(len(folds))))
+
+    n_jobs = n_jobs or os.cpu_count()
+    if n_jobs == 1:
+        results = [_fit_fold(folds, name, max_depth, fold, n_estimators) for name, max_depth, fold in tasks]
+    else:
+        with multiprocessing.Pool(n_jobs, initializer=_init_worker, initargs=(folds, n_estimators)) as pool:
+            results = pool.map(_fit_fold_worker, tasks, chunksize=1)
+
+    index = pd.MultiIndex.from_product([n_estimators, max_depths], names=['n_estimators', 'max_depth'])
+    logloss = pd.DataFrame(index=index, columns=MODELS, dtype=np.float64)
+    rocauc = pd.DataFrame(index=index, columns=MODELS, dtype=np.float64)
+    # Mean over folds of each model, max_depth and number of trees
+    scores = np.array(results).reshape(len(MODELS), len(max_depths), len(folds), len(n_estimators), 3)
+    for i, name in enumerate(MODELS):
+        logloss[name] = scores[i, :, :, :, 1].mean(axis=1).T.ravel()
+        rocauc[name] = scores[i, :, :, :, 2].mean(axis=1).T.ravel()
+
+    if len(n_estimators) == 1:
+        logloss, rocauc = logloss.loc[n_estimators[0]], rocauc.loc[n_estimators[0]]
+
+    return logloss, rocauc
+
+
+# Folds and numbers of trees used by the worker processes of walk_forward_search()
+_worker_folds = None
+_worker_n_estimators = None
+
+
+def _init_worker(folds, n_estimators):
+    global _worker_folds, _worker_n_estimators
+    _worker_folds = folds
+    _worker_n_estimators = n_estimators
+
+
+def _fit_fold_worker(task):
+    name, max_depth, fold = task
+    return _fit_fold(_worker_folds, name, max_depth, fold, _worker_n_estimators)
@@ -3,6 +3,9 @@ import pandas as pd
 import requests
 import zipfile
 import tempfile
+import multiprocessing
+import shutil
+import csv
 import os
 
 
@@ -90,44 +93,105 @@ def download_txt_files_from_google_drive(id='1zZ02PQKig89mikY5Xhks0vtvzcsr3Dd1',
             zip_ref.extractall(destination)
 
 
-def from_raw_txt_to_csv(input_directory='data/handles_raw_data', output_file='data/tweets.csv'):
+def _parse_raw_tweet(raw_tweet):
+    """
+    Split one line of a raw handle file into tweet_id, timestamp, handle and tweet
+
+    Parameters:
+        raw_tweet: string
+            Line of a raw text file, output from twint
+    Returns:
+        list or None if the line is not a tweet
+    """
+    # Split once. Lines are 'tweet_id date time timezone <handle> tweet', with at least one space in the tweet
+    fields = raw_tweet.split(' ', 6)
+    # Remove tweets that dont have an int as first element (tweet_id) or are too short
+    if len(fields) < 7 or not fields[0].isdigit():
+        return None
+
+    return [int(fields[0]),
+            fields[1] + ' ' + fields[2],
+            fields[4].strip('<>'),
+            (fields[5] + ' ' + fields[6]).rstrip('\n')]
+
+
+# Set of valid handles of the worker processes of from_raw_txt_to_csv(), sent once per worker
+_worker_raw_handles = None
+
+
+def _init_worker(raw_handles):
+    global _worker_raw_handles
+    _worker_raw_handles = raw_handles
+
+
+def _parse_raw_handle_file(args):
+    """
+    Parse a raw handle file line by line and write its tweets to a part csv file in chunks of chunk_size rows.
+    Only tweets of the handles given to _init_worker() are kept
+
+    Parameters:
+        args: tuple
+            (input file path, part file path, chunk_size)
+    Returns:
+        string
+            Path of the part file
+    """
+    input_file, part_file, chunk_size = args
+    raw_handles = _worker_raw_handles
+
+    with open(input_file, 'r') as f_in, open(part_file, 'w', newline='') as f_out:
+        writer = csv.writer(f_out, lineterminator='\n')
+        rows = []
+        for raw_tweet in f_in:
+            row = _parse_raw_tweet(raw_tweet)
+            # Remove tweets whose handle isn't in the raw_handle list
+            if row is None or row[2] not in raw_handles:
+                continue
+            rows.append(row)
+            if len(rows) >= chunk_size:
+                writer.writerows(rows)
+                rows = []
+        writer.writerows(rows)
+
+    return part_file
+
+
+def from_raw_txt_to_csv(input_directory='data/handles_raw_data', output_file='data/tweets.csv', n_jobs=None,
+                        chunk_size=100000):
     """
     Convert raw text files per handle into a csv with columns 'tweet_id', 'timestamp', 'handle', 'tweet'
 
+    Handle files are parsed line by line in parallel worker processes, and rows are written in chunks of
+    chunk_size, so memory use doesn't depend on the size of the corpus
+
     Parameters:
         input_directory: directory
             Directory where text files are located
         output_file: string
             File path where the file will be written to
+        n_jobs: int, optional
+            Number of worker processes. Defaults to the number of CPUs
+        chunk_size: int, optional
+            Maximum number of rows held in memory per worker before writing to disk
     """
     # Obtain a list of all text files with raw tweet data. One file per handle
     raw_handle_files = os.listdir(input_directory)
-    # List of all handles
-    raw_handles = [raw_handle_file[:-4] for raw_handle_file in raw_handle_files]
-
-    # List of all tweets in raw form
-    raw_tweets = []
-    for raw_handle_file in raw_handle_files:
-        with open(input_directory + '/' + raw_handle_file, 'r') as f:
-            raw_tweets += f.readlines()
-
-    # Remove tweets that dont have an int as first element (tweet_id)
-    raw_tweets = [raw_tweet for raw_tweet in raw_tweets if raw_tweet.split(' ')[0].isdigit()]
-
-    # Split tweets in raw form into tweet_id, timestamp, handle, raw_tweet
-    df_raw_tweets_input = [[int(raw_tweet.split(' ')[0]),
-                            ' '.join(raw_tweet.split(' ')[1:3]),
-                            raw_tweet.split(' ')[4].strip('<>'),
-                            ' '.join(raw_tweet.split(' ')[5:]).rstrip('\n')] for raw_tweet in raw_tweets
-                                                                                if len(raw_tweet.split(' ')) > 6]
-
-    # Create dataframe
-    tweets_df = pd.DataFrame(df_raw_tweets_input, columns=['tweet_id', 'timestamp', 'handle', 'tweet'])
-
-    # Remove tweets whose handle isn't in the raw_handle list
-    tweets_df = tweets_df[tweets_df.handle.isin(raw_handles)].reset_index(drop=True)
-
-    tweets_df.to_csv(output_file, index=False)
+    # Set of all handles
+    raw_handles = {raw_handle_file[:-4] for raw_handle_file in raw_handle_files}
+
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(output_file))) as tmpdir:
+        tasks = [(input_directory + '/' + raw_handle_file,
+                  tmpdir + '/{}.csv'.format(i),
+                  chunk_size) for i, raw_handle_file in enumerate(raw_handle_files)]
+
+        with open(output_file, 'w', newline='') as f_out:
+            f_out.write('tweet_id,timestamp,handle,tweet\n')
+            # imap keeps the order of the handle files, each part file is appended as soon as it's ready
+            with multiprocessing.Pool(n_jobs, initializer=_init_worker, initargs=(raw_handles,)) as pool:
+                for part_file in pool.imap(_parse_raw_handle_file, tasks):
+                    with open(part_file, 'r', newline='') as f_part:
+                        shutil.copyfileobj(f_part, f_out)
+                    os.remove(part_file)
 
     print("From raw text files to csv tweet database successful")
 
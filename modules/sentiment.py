@@ -0,0 +1,389 @@
+from transformers import AutoTokenizer, AutoModelForSequenceClassification
+import torch
+import torch.multiprocessing
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+import copy
+import hashlib
+import json
+import math
+import os
+import time
+
+# Model of the transformers 'sentiment-analysis' pipeline used in Sentiment.ipynb
+DEFAULT_MODEL = 'distilbert-base-uncased-finetuned-sst-2-english'
+
+
+class SentimentScorer:
+    """
+    Scores the sentiment of tweets with a sequence classification model from transformers. Same output as the
+    'sentiment-analysis' pipeline, but tweets are sorted by token length and batched by a token budget, so
+    batches contain little padding
+    """
+    # Pool of worker processes, started by the first call of score_texts() with n_jobs > 1 and kept until close()
+    _pool = None
+    _pool_settings = None
+
+    def __init__(self, model=DEFAULT_MODEL, tokenizer=None, max_tokens=4096, max_batch_size=128, max_length=512,
+                 positive_label='POSITIVE', cache=None, model_id=None, n_jobs=1, n_threads=None, quantize=False):
+        """
+        Parameters:
+            model: string or transformers model, optional
+                Name or path of a pretrained sequence classification model, or the model itself
+            tokenizer: string or transformers tokenizer, optional
+                Tokenizer of the model. Defaults to the tokenizer saved with model, required if model isn't a string
+            max_tokens: int, optional
+                Maximum number of tokens in a batch, including padding
+            max_batch_size: int, optional
+                Maximum number of tweets in a batch
+            max_length: int, optional
+                Tweets are truncated to max_length tokens
+            positive_label: string, optional
+                Label of the positive class in the model config. If the model has no such label, class 1 is positive
+            cache: SentimentCache, optional
+                Cache of scores from modules.sentiment_cache. Texts in the cache aren't scored again and new
+                scores are added to it
+            model_id: string, optional
+                Identity of the model in the cache. Defaults to the name or path the model was loaded from
+            n_jobs: int, optional
+                Number of worker processes scoring batches concurrently. Workers share the weights of the model
+                instead of each holding a copy, and are started once and reused until close(). If None, uses the
+                number of CPUs. Results are the same as with n_jobs=1 and the same n_threads
+            n_threads: int, optional
+                Number of intra-op threads of each process scoring batches, also used when n_jobs=1. Defaults
+                to the number of torch threads divided by n_jobs
+            quantize: bool, optional
+                If True, the weights of the linear layers are quantized to int8 and activations are quantized
+                on the fly (dynamic quantization). Faster on CPU, at the cost of small changes in scores, see
+                benchmark_quantization() in modules.benchmarks
+        """
+        if isinstance(model, str):
+            tokenizer = tokenizer or model
+            model = AutoModelForSequenceClassification.from_pretrained(model)
+        if isinstance(tokenizer, str):
+            tokenizer = AutoTokenizer.from_pretrained(tokenizer)
+        self.quantize = quantize
+        # Full precision model, kept for worker processes, see score_texts()
+        self.float_model = model.eval() if quantize else None
+        if quantize:
+            model = _quantize(model)
+        self.model = model.eval()
+        self.tokenizer = tokenizer
+        self.max_tokens = max_tokens
+        self.max_batch_size = max_batch_size
+        self.max_length = max_length
+        self.positive_id = {label.upper(): i for i, label in model.config.id2label.items()}.get(positive_label, 1)
+        self.cache = cache
+        # Truncation changes the scores of long texts, so it's part of the identity of the model
+        self.model_id = '{}|max_length={}'.format(model_id or model.config._name_or_path, max_length)
+        if quantize:
+            self.model_id += '|int8'
+        self.n_jobs = n_jobs or os.cpu_count()
+        self.n_threads = n_threads or max(1, torch.get_num_threads() // self.n_jobs)
+        self.stats = {}
+
+    def encode(self, tweets):
+        """
+        Token ids of each tweet, without padding
+
+        Parameters:
+            tweets: list or pandas Series[str]
+                Cleaned tweets, output of clean_sentiment() in modules.tweet_data
+        Returns:
+            List[List[int]]
+        """
+        return self.tokenizer(list(tweets), truncation=True, max_length=self.max_length)['input_ids']
+
+    def plan_batches(self, lengths):
+        """
+        Group tweets into batches of similar length. Tweets are sorted by length and a batch is closed when
+        adding the next tweet would exceed max_tokens or max_batch_size
+
+        Parameters:
+            lengths: array
+                Number of tokens of each tweet
+        Returns:
+            List[array]
+                Positions of the tweets of each batch
+        """
+        order = np.argsort(lengths, kind='stable')
+        batches = []
+        start = 0
+        for end in range(1, len(order) + 1):
+            # Tweets are sorted, so the padded length of a batch is the length of its last tweet
+            if end == len(order) or end + 1 - start > self.max_batch_size or \
+                    (end + 1 - start) * lengths[order[end]] > self.max_tokens:
+                batches.append(order[start:end])
+                start = end
+
+        return batches
+
+    def score_batch(self, input_ids):
+        """
+        Classify a batch of tokenized tweets
+
+        Parameters:
+            input_ids: List[List[int]]
+                Token ids of each tweet, output of encode()
+        Returns:
+            array, array
+                Sentiment (1 if positive, -1 if negative) and probability of the predicted class
+        """
+        inputs = self.tokenizer.pad({'input_ids': input_ids}, return_tensors='pt')
+        with torch.no_grad():
+            probs = torch.softmax(self.model(**inputs).logits, dim=-1).numpy()
+        labels = probs.argmax(axis=1)
+
+        return np.where(labels == self.positive_id, 1, -1), probs[np.arange(len(labels)), labels]
+
+    def score(self, tweets):
+        """
+        Score the sentiment of tweets. Each distinct text is only scored once, and not at all if it's in the
+        cache. Tweets per second, padding and the share of tweets that weren't scored by the model
+        ('dedup_ratio') are stored in stats
+
+        Parameters:
+            tweets: pandas Series[str]
+                Cleaned tweets, output of clean_sentiment() in modules.tweet_data
+        Returns:
+            pandas DataFrame
+                'sentiment' (1 if positive, -1 if negative) and 'score' (probability of the sentiment) of each
+                tweet, with the index of tweets
+        """
+        t = time.time()
+        # Integer code of the distinct text of each tweet
+        codes, texts = pd.factorize(np.asarray(tweets, dtype=object))
+
+        sentiment = np.zeros(len(texts), dtype=np.int64)
+        score = np.zeros(len(texts), dtype=np.float64)
+        if self.cache is None:
+            todo = np.arange(len(texts))
+        else:
+            keys = [self.cache.key(text) for text in texts]
+            found, sentiment, score = self.cache.load(self.model_id, keys)
+            todo = np.flatnonzero(~found)
+
+        sentiment[todo], score[todo] = self.score_texts(texts[todo])
+
+        if self.cache is not None and len(todo):
+            self.cache.save(self.model_id, [keys[i] for i in todo], sentiment[todo], score[todo])
+
+        seconds = time.time() - t
+        self.stats.update({'tweets': len(codes),
+                           'unique_texts': len(texts),
+                           'cache_hits': len(texts) - len(todo),
+                           'dedup_ratio': 1 - len(todo) / len(codes) if len(codes) else 0.,
+                           'seconds': seconds,
+                           'tweets_per_sec': len(codes) / seconds if seconds > 0 else float('inf')})
+
+        return pd.DataFrame({'sentiment': sentiment[codes], 'score': score[codes]},
+                            index=getattr(tweets, 'index', None))
+
+    def score_chunks(self, df, output_dir='data/sentiment', chunk_size=100000):
+        """
+        Score tweets in chunks of chunk_size tweets, writing each chunk to a Parquet file as soon as it's scored.
+        A manifest lists the completed chunks, so if scoring is interrupted, calling score_chunks() again with
+        the same arguments resumes from the first unfinished chunk. The manifest holds a fingerprint of the
+        tweets and their index, so scores of different tweets are never mixed
+
+        Parameters:
+            df: Pandas DataFrame
+                Output of read_raw_data() in modules.tweet_data, with tweets cleaned by clean_sentiment()
+            output_dir: string, optional
+                Directory where the chunks and the manifest are written to
+            chunk_size: int, optional
+                Number of tweets per chunk
+        Returns:
+            pandas DataFrame
+                Output of read_scores()
+        """
+        os.makedirs(output_dir, exist_ok=True)
+        manifest_path = os.path.join(output_dir, 'manifest.json')
+        settings = {'model': self.model_id, 'n_tweets': len(df), 'chunk_size': chunk_size,
+                    'fingerprint': fingerprint(df.tweet)}
+        manifest = {'settings': settings, 'chunks': []}
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+            if manifest['settings'] != settings:
+                raise ValueError("{} contains scores of a different run: {}".format(output_dir,
+                                                                                  manifest['settings']))
+        done = {chunk['index'] for chunk in manifest['chunks']}
+
+        columns = [column for column in ['tweet_id', 'handle'] if column in df]
+        n_chunks = math.ceil(len(df) / chunk_size)
+        t = time.time()
+        for i in range(n_chunks):
+            if i in done:
+                continue
+            print("Chunk {}/{}, time {:.2f}".format(i, n_chunks, (time.time() - t) / 60))
+            chunk = df.iloc[i * chunk_size:(i + 1) * chunk_size]
+            scores = chunk[columns].copy()
+            scores[['sentiment', 'score']] = self.score(chunk.tweet)
+
+            # Write to temporary files first so an interrupted run never leaves a truncated chunk or manifest
+            file_name = 'chunk-{:05d}.parquet'.format(i)
+            path = os.path.join(output_dir, file_name)
+            pq.write_table(pa.Table.from_pandas(scores.reset_index(), preserve_index=False), path + '.tmp')
+            os.replace(path + '.tmp', path)
+            manifest['chunks'].append({'index': i, 'file': file_name})
+            with open(manifest_path + '.tmp', 'w') as f:
+                json.dump(manifest, f)
+            os.replace(manifest_path + '.tmp', manifest_path)
+
+        print("Finished")
+
+        return read_scores(output_dir)
+
+    def score_texts(self, texts):
+        """
+        Score texts with the model, without the cache
+
+        Parameters:
+            texts: list or array of str
+        Returns:
+            array, array
+                Sentiment (1 if positive, -1 if negative) and probability of the sentiment of each text
+        """
+        if len(texts) == 0:
+            self.stats = {'scored': 0, 'batches': 0, 'padding_ratio': 0.}
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64)
+
+        t = time.time()
+        input_ids = self.encode(texts)
+        lengths = np.fromiter((len(ids) for ids in input_ids), dtype=np.int64, count=len(input_ids))
+        batches = self.plan_batches(lengths)
+
+        # Results are written in place, in the original order of the texts
+        sentiment = np.zeros(len(input_ids), dtype=np.int64)
+        score = np.zeros(len(input_ids), dtype=np.float64)
+        batch_ids = ([input_ids[i] for i in batch] for batch in batches)
+        # The number of threads changes how float sums are split, so both paths use n_threads
+        n_threads = torch.get_num_threads()
+        if self.n_jobs == 1:
+            torch.set_num_threads(self.n_threads)
+            results = map(self.score_batch, batch_ids)
+        else:
+            # Batches are planned here for all texts, so workers score exactly the same batches as a single
+            # process would
+            results = self._get_pool().imap(_score_batch_worker, batch_ids)
+
+        try:
+            n_done = 0
+            for batch, (batch_sentiment, batch_score) in zip(batches, results):
+                if n_done // 10000 != (n_done + len(batch)) // 10000:
+                    print("{}/{}, time {:.2f}".format(n_done, len(input_ids), (time.time() - t) / 60), end="\r")
+                sentiment[batch], score[batch] = batch_sentiment, batch_score
+                n_done += len(batch)
+        except BaseException:
+            # Don't leave workers busy with the batches of an interrupted call
+            self.close()
+            raise
+        finally:
+            torch.set_num_threads(n_threads)
+
+        padded = sum(len(batch) * lengths[batch].max() for batch in batches)
+        self.stats = {'scored': len(input_ids),
+                      'batches': len(batches),
+                      'padding_ratio': float(1 - lengths.sum() / padded) if padded else 0.}
+
+        return sentiment, score
+
+    def _get_pool(self):
+        """
+        Pool of n_jobs worker processes, started on first use and restarted if n_jobs or n_threads changed.
+        Weights are moved to shared memory once and mapped by every worker
+        """
+        settings = (self.n_jobs, self.n_threads)
+        if self._pool is None or self._pool_settings != settings:
+            self.close()
+            worker = copy.copy(self)
+            worker.cache = None
+            if self.quantize:
+                # Quantized weights can't be moved to shared memory, workers share the full precision weights
+                # and quantize them, which gives the same model
+                worker.model = self.float_model
+            worker.model.share_memory()
+            self._pool = torch.multiprocessing.get_context('spawn').Pool(self.n_jobs, initializer=_init_worker,
+                                                                         initargs=(worker, self.n_threads))
+            self._pool_settings = settings
+
+        return self._pool
+
+    def close(self):
+        """
+        Stop the worker processes, if any. They are started again by the next call with n_jobs > 1
+        """
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool = self._pool_settings = None
+
+    def __getstate__(self):
+        # Worker processes get a copy of the scorer without the pool
+        state = self.__dict__.copy()
+        state.pop('_pool', None)
+        state.pop('_pool_settings', None)
+        return state
+
+
+# SentimentScorer used by the worker processes of SentimentScorer.score_texts()
+_worker_scorer = None
+
+
+def _init_worker(scorer, n_threads):
+    global _worker_scorer
+    _worker_scorer = scorer
+    torch.set_num_threads(n_threads)
+    if scorer.quantize:
+        scorer.model = _quantize(scorer.float_model)
+
+
+def _quantize(model):
+    """
+    Dynamic int8 quantization of the linear layers of a model. Returns a quantized copy, model is unchanged
+    """
+    return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def _score_batch_worker(input_ids):
+    return _worker_scorer.score_batch(input_ids)
+
+
+def fingerprint(tweets):
+    """
+    Hash of tweets and their index, to check that a run of score_chunks() resumes on the same data
+
+    Parameters:
+        tweets: pandas Series[str]
+    Returns:
+        string
+    """
+    return hashlib.sha1(pd.util.hash_pandas_object(tweets, index=True).values.tobytes()).hexdigest()
+
+
+def read_scores(output_dir='data/sentiment'):
+    """
+    Load the completed chunks written by SentimentScorer.score_chunks() as one DataFrame. The chunks are read
+    as a single Parquet dataset, without concatenating a DataFrame per chunk
+
+    Parameters:
+        output_dir: string, optional
+            Directory the chunks were written to
+    Returns:
+        pandas DataFrame
+            tweet_id, handle, sentiment and score of each tweet, indexed by timestamp
+    """
+    with open(os.path.join(output_dir, 'manifest.json')) as f:
+        manifest = json.load(f)
+    files = [os.path.join(output_dir, chunk['file'])
+             for chunk in sorted(manifest['chunks'], key=lambda chunk: chunk['index'])]
+
+    df = ds.dataset(files, format='parquet').to_table().to_pandas()
+    if 'timestamp' in df:
+        df.set_index('timestamp', inplace=True)
+
+    return df
@@ -0,0 +1,92 @@
+import numpy as np
+
+import hashlib
+import os
+import sqlite3
+
+
+class SentimentCache:
+    """
+    On-disk cache of sentiment scores in a SQLite database. Scores are keyed by the identity of the model and
+    a hash of the cleaned text of the tweet, so each distinct text is only scored once per model
+    """
+    def __init__(self, path='data/sentiment_cache.sqlite'):
+        """
+        Parameters:
+            path: string, optional
+                Path of the SQLite database
+        """
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS scores (model TEXT, hash BLOB, sentiment INTEGER, "
+                                "score REAL, PRIMARY KEY (model, hash)) WITHOUT ROWID")
+        self.connection.commit()
+
+    @staticmethod
+    def key(text):
+        """
+        Hash of a cleaned tweet
+
+        Parameters:
+            text: string
+        Returns:
+            bytes
+        """
+        return hashlib.sha1(text.encode('utf-8')).digest()
+
+    def load(self, model, keys):
+        """
+        Look up the scores of many texts at once
+
+        Parameters:
+            model: string
+                Identity of the model
+            keys: List[bytes]
+                Output of key() for each text
+        Returns:
+            array, array, array
+                Whether each text is in the cache, its sentiment and its score. Sentiment and score are 0 for
+                texts that aren't in the cache
+        """
+        found = np.zeros(len(keys), dtype=bool)
+        sentiment = np.zeros(len(keys), dtype=np.int64)
+        score = np.zeros(len(keys), dtype=np.float64)
+
+        # Join against a temporary table of the keys instead of one query per text
+        self.connection.execute("CREATE TEMP TABLE IF NOT EXISTS lookup (position INTEGER, hash BLOB)")
+        self.connection.execute("DELETE FROM lookup")
+        self.connection.executemany("INSERT INTO lookup VALUES (?, ?)", enumerate(keys))
+        rows = self.connection.execute("SELECT lookup.position, scores.sentiment, scores.score FROM lookup "
+                                       "JOIN scores ON scores.model = ? AND scores.hash = lookup.hash",
+                                       (model,)).fetchall()
+        self.connection.execute("DELETE FROM lookup")
+
+        if rows:
+            positions, sentiment_rows, score_rows = zip(*rows)
+            positions = np.array(positions)
+            found[positions] = True
+            sentiment[positions] = sentiment_rows
+            score[positions] = score_rows
+
+        return found, sentiment, score
+
+    def save(self, model, keys, sentiment, score):
+        """
+        Write the scores of many texts at once
+
+        Parameters:
+            model: string
+                Identity of the model
+            keys: List[bytes]
+                Output of key() for each text
+            sentiment: array
+                Sentiment of each text
+            score: array
+                Score of each text
+        """
+        self.connection.executemany("INSERT OR REPLACE INTO scores VALUES (?, ?, ?, ?)",
+                                    zip([model] * len(keys), keys, np.asarray(sentiment).tolist(),
+                                        np.asarray(score).tolist()))
+        self.connection.commit()
@@ -1,11 +1,36 @@
-from spacy.tokenizer import _get_regex_pattern
-from spacy.tokens import Token
-import spacy
+import numpy as np
+
+import importlib.metadata
 import re
 
 
+DEFAULT_MODEL = 'en_core_web_sm'
+
+PICLINK_RE = re.compile("pic.twitter.com\S+")
+HASHTAG_RE = re.compile("#\w+")
+
+# Spacy models loaded in this process, by model name
+_models = {}
+
+
+def load_model(model):
+    """
+    Load a Spacy model. Spacy is only imported here and in spacy_twitter_model(), the first time a model is
+    needed, so that importing modules doesn't pay for it
+
+    Parameters:
+        model: string
+            Name of Spacy model to load
+    Returns:
+        Spacy model
+    """
+    import spacy
+
+    return spacy.load(model)
+
+
 # Idea from https://stackoverflow.com/questions/43388476/how-could-spacy-tokenize-hashtag-as-a-whole
-def spacy_twitter_model(model='en_core_web_sm'):
+def spacy_twitter_model(model=DEFAULT_MODEL):
     """
     Load Spacy model, adding capability to detect Twitter picture links and hashtags
     into Spacy's tokenizer
@@ -16,7 +41,10 @@ def spacy_twitter_model(model='en_core_web_sm'):
     Returns:
         Spacy model
     """
-    nlp = spacy.load(model)
+    from spacy.tokenizer import _get_regex_pattern
+    from spacy.tokens import Token
+
+    nlp = load_model(model)
 
     nlp.Defaults.stop_words |= {'yeah', 'yep', 'ah', 'nah', 'lol', 'oh', 'yes', 'ha', 'haha', 'hahaha', 'maybe',
                                 'like', 'cc', 'let', 'thank', 'thanks', 'sorry', 'fwiw', 'wow', 'icymi'}
@@ -28,10 +56,96 @@ def spacy_twitter_model(model='en_core_web_sm'):
     nlp.tokenizer.token_match = re.compile(re_token_match).match
     # set a custom extension to match if token is a piclink and hashtag
     Token.set_extension('is_piclink',
-                        getter=lambda token: bool(re.match("pic.twitter.com\S+", token.text)),
+                        getter=lambda token: bool(PICLINK_RE.match(token.text)),
                         force=True)
     Token.set_extension('is_hashtag',
-                        getter=lambda token: bool(re.match("#\w+", token.text)),
+                        getter=lambda token: bool(HASHTAG_RE.match(token.text)),
                         force=True)
 
     return nlp
+
+
+def model_versions(model=DEFAULT_MODEL):
+    """
+    Installed versions of Spacy and of a Spacy model, read from the package metadata without importing Spacy
+    or loading the model. Part of the token cache key, so cached tokens aren't used after an upgrade
+
+    Parameters:
+        model: string, optional
+            Name of Spacy model. Defaults to en_core_web_sm
+    Returns:
+        dict
+            'spacy' and 'model' versions, None if a package isn't installed
+    """
+    versions = {}
+    for name, package in [('spacy', 'spacy'), ('model', model)]:
+        try:
+            versions[name] = importlib.metadata.version(package)
+        except importlib.metadata.PackageNotFoundError:
+            versions[name] = None
+
+    return versions
+
+
+def get_nlp(model=DEFAULT_MODEL):
+    """
+    Spacy model from spacy_twitter_model(), loaded the first time it's needed and then cached for the
+    rest of the process
+
+    Parameters:
+        model: string, optional
+            Name of Spacy model to load. Defaults to en_core_web_sm
+    Returns:
+        Spacy model
+    """
+    if model not in _models:
+        _models[model] = spacy_twitter_model(model)
+
+    return _models[model]
+
+
+def twitter_token_mask(doc, urls=True, stop_words=True, alpha_only=True, hashtags=False):
+    """
+    Mask of the tokens of a Doc kept by TopicSeries.twitter_tokenizer(), computed from arrays of token
+    attributes. Only tokens that can't be decided from the attributes are matched against the piclink
+    and hashtag patterns
+
+    Parameters:
+        doc: Spacy Doc
+        urls: bool, optional
+            If True, remove picture links
+        stop_words: bool, optional
+            If True, removes stop words
+        alpha_only: bool, optional
+            If True, removes all non-alpha tokens except hashtags
+        hashtags: bool, optional
+            If True, remove hashtags
+    Returns:
+        numpy array[bool], array[uint64]
+            Mask of kept tokens, and ORTH hash of each token
+    """
+    from spacy.attrs import LIKE_URL, IS_STOP, IS_ALPHA, ORTH
+
+    attrs = doc.to_array([LIKE_URL, IS_STOP, IS_ALPHA, ORTH]).reshape(len(doc), 4)
+    like_url, is_stop, is_alpha = attrs[:, :3].T.astype(bool)
+    orth = attrs[:, 3]
+
+    # remove URLs
+    keep = ~like_url
+    # only include stop words if stop words==True
+    if stop_words:
+        keep &= ~is_stop
+    # if alpha_only=True, only include alpha characters unless they are hashtags
+    alpha = is_alpha & alpha_only
+    if hashtags:
+        keep &= alpha
+    else:
+        for i in np.flatnonzero(keep & ~alpha):
+            keep[i] = HASHTAG_RE.match(doc.vocab.strings[orth[i]]) is not None
+    # remove picture links, which are only checked for the tokens still kept
+    if urls:
+        for i in np.flatnonzero(keep):
+            if PICLINK_RE.match(doc.vocab.strings[orth[i]]):
+                keep[i] = False
+
+    return keep, orth
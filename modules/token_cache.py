@@ -0,0 +1,90 @@
+import numpy as np
+
+import hashlib
+import json
+import os
+
+
+class TokenCache:
+    """
+    On-disk cache of tokenized tweets, one file per trading day. Each file is keyed by the date and a hash of
+    the source tweets and tokenizer settings, and stores the tokens as an array of token ids, an array of
+    document offsets and the vocabulary of the day
+    """
+    def __init__(self, cache_dir='data/token_cache'):
+        """
+        Parameters:
+            cache_dir: string, optional
+                Directory where cache files are written to
+        """
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(tweets, **settings):
+        """
+        Hash of a day of tweets and the settings used to tokenize them
+
+        Parameters:
+            tweets: iterable of str
+                Tweets of a trading day
+            settings: keyword arguments
+                Tokenizer flags, model name and anything else that changes the tokens
+        Returns:
+            string
+        """
+        h = hashlib.sha1(json.dumps(settings, sort_keys=True).encode('utf-8'))
+        for tweet in tweets:
+            h.update(tweet.encode('utf-8'))
+            h.update(b'\0')
+
+        return h.hexdigest()
+
+    def path(self, date, key):
+        return os.path.join(self.cache_dir, '{}-{}.npz'.format(date, key[:20]))
+
+    def load(self, date, key):
+        """
+        Load the tokens of a trading day
+
+        Parameters:
+            date: string
+                Date in 'yyyy-mm-dd' format
+            key: string
+                Output of key()
+        Returns:
+            List[List[str]] or None if the day isn't in the cache
+        """
+        path = self.path(date, key)
+        if not os.path.exists(path):
+            return None
+
+        with np.load(path) as f:
+            vocab = f['vocab'].astype(object)
+            tokens = vocab[f['ids']].tolist()
+            offsets = f['offsets'].tolist()
+
+        return [tokens[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+
+    def save(self, date, key, docs):
+        """
+        Write the tokens of a trading day
+
+        Parameters:
+            date: string
+                Date in 'yyyy-mm-dd' format
+            key: string
+                Output of key()
+            docs: List[List[str]]
+                Tokens of each tweet
+        """
+        vocab = {}
+        ids = np.fromiter((vocab.setdefault(token, len(vocab)) for doc in docs for token in doc), dtype=np.int32)
+        offsets = np.zeros(len(docs) + 1, dtype=np.int64)
+        np.cumsum([len(doc) for doc in docs], out=offsets[1:])
+
+        # Write to a temporary file first so an interrupted run never leaves a truncated cache file
+        tmp_path = self.path(date, key) + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, ids=ids, offsets=offsets, vocab=np.array(list(vocab), dtype=str))
+        os.replace(tmp_path, self.path(date, key))
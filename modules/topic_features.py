@@ -0,0 +1,112 @@
+from .topics import TopicSeries, transform_error, top_indices, _vectorizer_words
+from .coherence import WordEmbeddings, topic_vectors, coherence_scores, COHERENCE_MODEL
+from .tweet_data import read_raw_data, read_tweet_store, open_tweet_store
+from .spacy import load_model
+
+import numpy as np
+
+import csv
+import datetime as dt
+import os
+
+NMF_FEATURES = ['topic_coherence', 'topic_coherence_diff', 'recon_ratio']
+
+
+def _windows(df, date_range):
+    """
+    Tweets of each trading day. A tweet store is read one day at a time, so only one day of tweets is in memory
+    """
+    if not isinstance(df, str):
+        yield from TopicSeries._day_windows(df, date_range)
+    elif not os.path.isdir(df):
+        yield from TopicSeries._day_windows(read_raw_data(df, start=date_range[0], end=date_range[-1],
+                                                          columns=['tweet']), date_range)
+    else:
+        # Partitions are discovered once, each day only reads its own partitions
+        dataset = open_tweet_store(df)
+        for i in range(len(date_range) - 1):
+            tweets = read_tweet_store(df, start=date_range[i], end=date_range[i + 1] - dt.timedelta(seconds=1),
+                                      columns=['tweet'], dataset=dataset).tweet
+            yield str(date_range[i + 1].date()), tweets
+
+
+def topic_feature_rows(df, date_range, ts=None, embeddings=None, nlp=None, top_display=20):
+    """
+    Generator of the rows of nmf_features.csv in one sweep over the trading days. Each day is tokenized once
+    and its TF-IDF and NMF models are fitted as in TopicSeries.fit(), then used for the day's row and for the
+    next day's reconstruction error and coherence diff. Only the models of the previous and current day are
+    kept, so memory doesn't grow with the number of days
+
+    Parameters:
+        df: Pandas DataFrame or str
+            Output of read_raw_data() method in modules.tweet_data, or path to a tweet store, which is read one
+            day at a time
+        date_range: DatetimeIndex
+            DateTimeIndex of dates which will serve as range for the data
+        ts: TopicSeries, optional
+            TopicSeries with the settings to use (n_components, random_state, token cache, tokenizer). Models
+            aren't added to it and shared_vocab isn't used. Defaults to TopicSeries()
+        embeddings: WordEmbeddings, optional
+            Embeddings of the top words, for example saved by an earlier run. Words without embeddings are
+            skipped. If None, the vectors of each day's top words are looked up with nlp
+        nlp: Spacy model, optional
+            Model with word vectors, used if embeddings is None. Defaults to en_core_web_md
+        top_display: int, optional
+            Number of top words per topic for coherence
+    Yields:
+        tuple
+            (date in 'yyyy-mm-dd' format, topic_coherence, topic_coherence_diff, recon_ratio), from the second
+            day of date_range on
+    """
+    ts = ts or TopicSeries()
+    # Copy of the settings, each day gets its own vectorizer
+    settings = TopicSeries(ts.n_components, ts.random_state, tokenizer_flags=ts.tokenizer_flags,
+                           tokenizer_backend=ts.tokenizer_backend)
+    settings.token_cache = ts.token_cache
+    if embeddings is None and nlp is None:
+        nlp = load_model(COHERENCE_MODEL)
+
+    prev = None
+    for str_date, tweets in _windows(df, date_range):
+        data = settings.tokenize(str_date, tweets)
+        tfidf, nmf = settings._fit_nmf(data)
+
+        word_features = _vectorizer_words(tfidf)
+        words = [[word_features[i] for i in topic if i >= 0] for topic in top_indices(nmf.components_, top_display)]
+        day_embeddings = embeddings or WordEmbeddings.build(sorted(set(w for topic in words for w in topic)), nlp)
+        vectors = topic_vectors(day_embeddings, words)
+
+        if prev is not None:
+            prev_tfidf, prev_nmf, prev_vectors = prev
+            # Previous day's models applied to this day's tweets, as in TopicSeries.calc_rec_error()
+            new_rec_err = transform_error(prev_nmf, prev_tfidf.transform(data))
+            topic_coherence, topic_coherence_diff = coherence_scores(np.stack([prev_vectors, vectors]))
+            yield str_date, topic_coherence[0], topic_coherence_diff[0], nmf.reconstruction_err_ / new_rec_err - 1
+
+        prev = tfidf, nmf, vectors
+
+
+def write_topic_features(df, date_range, output_file='data/nmf_features.csv', **kwargs):
+    """
+    Write nmf_features.csv one row at a time as topic_feature_rows() produces them. Dates are written as
+    dd/mm/yyyy like the existing file, which Market.ipynb reads with dayfirst=True
+
+    Parameters:
+        df: Pandas DataFrame or str
+            Output of read_raw_data() method in modules.tweet_data, or path to a tweet store
+        date_range: DatetimeIndex
+            DateTimeIndex of dates which will serve as range for the data
+        output_file: string, optional
+            Path of the csv file
+        kwargs: keyword arguments
+            Passed to topic_feature_rows()
+    """
+    with open(output_file, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['Date'] + NMF_FEATURES)
+        for row in topic_feature_rows(df, date_range, **kwargs):
+            print("Working on : ", row[0], end="\r")
+            writer.writerow([dt.datetime.strptime(row[0], '%Y-%m-%d').strftime('%d/%m/%Y')] + list(row[1:]))
+            f.flush()
+
+    print("\nFinished")
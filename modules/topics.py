@@ -1,37 +1,81 @@
-from.spacy import spacy_twitter_model
+from .spacy import get_nlp, twitter_token_mask, model_versions, DEFAULT_MODEL
+from .tweet_data import read_raw_data
+from .token_cache import TokenCache
 
-from sklearn.feature_extraction.text import CountVectorizer, TfidfVectorizer
-from sklearn.decomposition import NMF, LatentDirichletAllocation
+from sklearn.feature_extraction.text import CountVectorizer, TfidfVectorizer, TfidfTransformer
+from sklearn.decomposition import NMF, LatentDirichletAllocation, non_negative_factorization
 from sklearn.decomposition._nmf import _beta_divergence
+from sklearn.utils import check_random_state
+from threadpoolctl import threadpool_limits
+from scipy.special import psi
+from scipy.sparse import csr_matrix
+import numpy as np
 
 import pickle
+import copy
+import inspect
+import collections
+import collections.abc
+import bisect
+import multiprocessing
+import json
+import os
+import shutil
 import datetime as dt
 
 from warnings import simplefilter
 from sklearn.exceptions import ConvergenceWarning
 simplefilter("ignore", category=ConvergenceWarning)
 
-nlp = spacy_twitter_model()
-
 
 class TopicSeries:
     """
     Class that holds a time series of Topic models
     """
-    def __init__(self, n_components=5, random_state=42):
+    # Class level defaults, so TopicSeries pickled before these attributes existed can still be used
+    token_cache = None
+    tokenizer_flags = {}
+    tokenizer_backend = 'array'
+    shared_vocab = False
+    top_index = None
+
+    def __init__(self, n_components=5, random_state=42, cache_dir=None, tokenizer_flags=None,
+                 tokenizer_backend='array', shared_vocab=False):
         """
         Parameters:
             n_components: int, optional
                 Number of topics for each topic model
             random_state: int, optional
                 Random seed for NMF and LatentDirichletAllocation
+            cache_dir: string, optional
+                Directory of an on-disk token cache shared by fit() and calc_rec_error(). If None, tweets
+                are tokenized every time
+            tokenizer_flags: dict, optional
+                Keyword arguments passed to twitter_tokenizer()
+            tokenizer_backend: string, optional
+                'array' to tokenize with array_tokenizer(), 'python' to tokenize with twitter_tokenizer().
+                Both return the same tokens
+            shared_vocab: bool, optional
+                If True, words of all days share one append-only vocabulary. Each day's document-term count
+                matrix is built once and kept in dtm_dict, with the vocabulary ids of its columns in
+                features_dict. tfidf_dict then holds TfidfTransformers fitted on those counts and cv_dict
+                isn't used. Models are the same as with shared_vocab=False
         """
         self.n_components = n_components
         self.random_state = random_state
+        self.token_cache = TokenCache(cache_dir) if cache_dir is not None else None
+        self.tokenizer_flags = tokenizer_flags or {}
+        self.tokenizer_backend = tokenizer_backend
+        self.shared_vocab = shared_vocab
         self.cv_dict = {}
         self.tfidf_dict = {}
         self.nmf_dict = {}
         self.lda_dict = {}
+        # Shared vocabulary, word to id and id to word, only used if shared_vocab=True
+        self.vocab = {}
+        self.vocab_words = []
+        self.features_dict = {}
+        self.dtm_dict = {}
 
     def calculate_nmf(self, date, data):
         """
@@ -43,15 +87,8 @@ class TopicSeries:
             data: Pandas DataFrame
                 Data for a particular date range for the output of read_raw_data() method in modules.tweet_data
         """
-        # TF-IDF model, token_pattern is alpha only words + hashtags
-        tfidf = TfidfVectorizer(tokenizer=self.tokenizer, lowercase=False)
-        tfidf_vecs = tfidf.fit_transform(data)
-        # Fit NMF model with n_components topics with TF-IDF input
-        nmf = NMF(n_components=self.n_components, random_state=self.random_state)
-        nmf.fit_transform(tfidf_vecs)
         # Add TFIDF and NMF models to their respective dictionaries, with date as key
-        self.tfidf_dict[date] = tfidf
-        self.nmf_dict[date] = nmf
+        self.tfidf_dict[date], self.nmf_dict[date] = self._fit_nmf(self._day_data(date, data))
 
     def calculate_lda(self, date, data):
         """
@@ -63,49 +100,326 @@ class TopicSeries:
             data: Pandas DataFrame
                 Data for a particular date range for the output of read_raw_data() method in modules.tweet_data
         """
-        # TF-IDF model, token_pattern is alpha only words + hashtags
-        cv = CountVectorizer(tokenizer=self.tokenizer, lowercase=False)
-        count_vecs = cv.fit_transform(data)
-        # Fit LDA model with n_components topics with cv input
-        lda = LatentDirichletAllocation(n_components=self.n_components, random_state=self.random_state)
-        lda.fit_transform(count_vecs)
         # Add CountVectorizer and LDA models to their respective dictionaries, with date as key
-        self.cv_dict[date] = cv
-        self.lda_dict[date] = lda
+        self.cv_dict[date], self.lda_dict[date] = self._fit_lda(self._day_data(date, data))
 
-    def fit(self, df, date_range):
+    def _day_data(self, date, data):
         """
-        Fit NMF and LDA models for a range of dates
+        Input of _fit_nmf() and _fit_lda() for a day of tokenized tweets. With shared_vocab=True, the day's
+        count matrix, which is stored with its words added to the shared vocabulary
+        """
+        if not self.shared_vocab:
+            return data
+        matrix = _count_matrix(data)
+        self._store_matrix(date, *matrix)
+
+        return matrix
+
+    def _fit_nmf(self, data, init_date=None, max_iter=200):
+        if self.shared_vocab:
+            # data is the day's (words, count matrix), TF-IDF is computed from the counts
+            words, count_vecs = data
+            # Float copy of the counts with the same index order, as TfidfVectorizer computes them
+            tfidf_vecs = csr_matrix((count_vecs.data.astype(np.float64), count_vecs.indices.copy(),
+                                     count_vecs.indptr.copy()), shape=count_vecs.shape)
+            tfidf = TfidfTransformer().fit(tfidf_vecs)
+            tfidf_vecs = tfidf.transform(tfidf_vecs, copy=False)
+        else:
+            # TF-IDF model, token_pattern is alpha only words + hashtags
+            tfidf = TfidfVectorizer(tokenizer=self.tokenizer, lowercase=False)
+            tfidf_vecs = tfidf.fit_transform(data)
+            words = _vectorizer_words(tfidf)
+        # Fit NMF model with n_components topics with TF-IDF input
+        nmf = NMF(n_components=self.n_components, random_state=self.random_state)
+        if init_date is None:
+            nmf.fit_transform(tfidf_vecs)
+            return tfidf, nmf
+
+        # Warm start from init_date's topics, mapped onto this day's vocabulary. Words that are new today start at 0
+        H = _map_components(self.nmf_dict[init_date].components_, self.get_feature_names(init_date), words, fill=0.)
+        # Components of a series opened with load_compact() are float32
+        H = H.astype(tfidf_vecs.dtype, copy=False)
+        if H.max() == 0:
+            # No words in common with init_date, nothing to warm start from
+            nmf.fit_transform(tfidf_vecs)
+            return tfidf, nmf
+        # Initial document weights for the mapped topics
+        W, _, _ = non_negative_factorization(tfidf_vecs, H=H, n_components=self.n_components, update_H=False)
+        # Sklearn's stopping criterion is relative to the first iteration, which is already close to the optimum
+        # when warm starting, so the iterations are capped instead
+        nmf.set_params(init='custom', max_iter=max_iter)
+        nmf.fit_transform(tfidf_vecs, W=W, H=H)
+
+        return tfidf, nmf
+
+    def _fit_lda(self, data, init_date=None):
+        if self.shared_vocab:
+            # data is the day's (words, count matrix)
+            cv = None
+            words, count_vecs = data
+        else:
+            # TF-IDF model, token_pattern is alpha only words + hashtags
+            cv = CountVectorizer(tokenizer=self.tokenizer, lowercase=False)
+            count_vecs = cv.fit_transform(data)
+            words = _vectorizer_words(cv)
+        if init_date is None:
+            # Fit LDA model with n_components topics with cv input
+            lda = LatentDirichletAllocation(n_components=self.n_components, random_state=self.random_state)
+            lda.fit_transform(count_vecs)
+            return cv, lda
+
+        # Online update of init_date's LDA model, with its topics mapped onto this day's vocabulary. Words that
+        # are new today start at the topic word prior
+        lda = copy.deepcopy(self.lda_dict[init_date])
+        # Components of a series opened with load_compact() are float32, LDA models are fitted in float64
+        lda.components_ = _map_components(lda.components_, self.get_feature_names(init_date), words,
+                                          fill=lda.topic_word_prior_).astype(np.float64, copy=False)
+        lda.exp_dirichlet_component_ = np.exp(psi(lda.components_) - psi(lda.components_.sum(axis=1))[:, np.newaxis])
+        lda.n_features_in_ = count_vecs.shape[1]
+        lda.partial_fit(count_vecs)
+
+        return cv, lda
+
+    def _fit_day(self, window, nmf_init_date=None, lda_init_date=None, max_iter=200):
+        """
+        Tokenize a trading day and fit its models, without adding them to the dictionaries
+
+        Parameters:
+            window: tuple
+                (date in 'yyyy-mm-dd' format, pandas Series[str] of tweets), output of _day_windows()
+            nmf_init_date: string, optional
+                Date whose NMF model is used to warm start this day's model
+            lda_init_date: string, optional
+                Date whose LDA model is updated online with this day's data
+            max_iter: int, optional
+                Maximum number of iterations of a warm started NMF model
+        Returns:
+            tuple
+                (date, tfidf, nmf, cv, lda, matrix). If shared_vocab=True, cv is None and matrix is the day's
+                (words, count matrix), otherwise matrix is None
+        """
+        str_date, tweets = window
+        data = self.tokenize(str_date, tweets)
+        matrix = None
+        if self.shared_vocab:
+            # Count words once, the counts are used for both TF-IDF and LDA
+            data = matrix = _count_matrix(data)
+
+        tfidf, nmf = self._fit_nmf(data, init_date=nmf_init_date, max_iter=max_iter)
+        cv, lda = self._fit_lda(data, init_date=lda_init_date)
+
+        return str_date, tfidf, nmf, cv, lda, matrix
+
+    @staticmethod
+    def _day_windows(df, date_range):
+        """
+        Generator of the tweets of each trading day in date_range
 
         Parameters:
             df: Pandas DataFrame
-                Data for a particular date range for the output of read_raw_data() method in modules.tweet_data
+                Output of read_raw_data() method in modules.tweet_data
+            date_range: DateTimeIndex
+                DateTimeIndex of dates which will serve as range for the data
+        Yields:
+            tuple
+                (date in 'yyyy-mm-dd' format, pandas Series[str] of tweets)
+        """
+        for i in range(len(date_range) - 1):
+            # Take portion of df in the range of a trading day
+            yield str(date_range[i + 1].date()), df[date_range[i]:(date_range[i + 1] - dt.timedelta(seconds=1))].tweet
+
+    def fit(self, df, date_range, n_jobs=1):
+        """
+        Fit NMF and LDA models for a range of dates
+
+        Parameters:
+            df: Pandas DataFrame or str
+                Data for a particular date range for the output of read_raw_data() method in modules.tweet_data,
+                or path to a tweet store, from which only the tweets in date_range are read
             date_range: DateTimeIndex
                 DateTimeIndex of dates which will serve as range for fitting the data
+            n_jobs: int, optional
+                Number of worker processes fitting days concurrently. If None, uses the number of CPUs.
+                Results are the same as with n_jobs=1
         """
+        if isinstance(df, str):
+            df = read_raw_data(df, start=date_range[0], end=date_range[-1], columns=['tweet'])
 
-        for i in range(len(date_range) - 1):
+        self._fit_windows(self._day_windows(df, date_range), n_jobs)
 
-            str_date = str(date_range[i + 1].date())
+        print("\nFinished")
+
+    def _fit_windows(self, windows, n_jobs=1):
+        """
+        Fit the models of each trading day in windows and add them to the dictionaries, in order of the days
+
+        Parameters:
+            windows: iterable of tuples
+                (date in 'yyyy-mm-dd' format, pandas Series[str] of tweets), output of _day_windows()
+            n_jobs: int, optional
+                Number of worker processes. If None, uses the number of CPUs
+        """
+        if n_jobs == 1:
+            self._store_days(map(self._fit_day, windows))
+            return
+
+        # Workers get a copy of the TopicSeries settings, without any fitted models
+        worker_series = TopicSeries(self.n_components, self.random_state, tokenizer_flags=self.tokenizer_flags,
+                                    tokenizer_backend=self.tokenizer_backend, shared_vocab=self.shared_vocab)
+        worker_series.token_cache = self.token_cache
+
+        n_jobs = n_jobs or os.cpu_count()
+        with multiprocessing.Pool(n_jobs, initializer=_init_worker, initargs=(worker_series,)) as pool:
+            self._store_days(_ordered_imap(pool, _fit_day_worker, windows, 2 * n_jobs))
+
+    def _store_days(self, results):
+        # Results arrive in order of the days, only the main process prints progress
+        for str_date, tfidf, nmf, cv, lda, matrix in results:
             print("Working on : ", str_date, end="\r")
-            # Take portion of df in the range of a trading day
-            sub_df = df[date_range[i]:(date_range[i + 1] - dt.timedelta(seconds=1))].tweet
-            # Tokenize with Spacy NLP pipe. Disable tagger, parser and ner for faster calculation
-            sub_df = [self.twitter_tokenizer(text) for text in nlp.pipe(sub_df, disable=["tagger", "parser", "ner"])]
-            # Calculate NMF model
-            self.calculate_nmf(str_date, sub_df)
-            # Calculate LDA model
-            self.calculate_lda(str_date, sub_df)
+            self.tfidf_dict[str_date], self.nmf_dict[str_date] = tfidf, nmf
+            self.lda_dict[str_date] = lda
+            if matrix is None:
+                self.cv_dict[str_date] = cv
+            else:
+                self._store_matrix(str_date, *matrix)
+            if self.top_index is not None:
+                self.top_index.add(str_date, self.get_feature_names(str_date), nmf.components_)
+
+    def _store_matrix(self, date, words, count_vecs):
+        """
+        Add a day's words to the shared vocabulary and store its count matrix
+        """
+        features = np.empty(len(words), dtype=np.int32)
+        for j, word in enumerate(words):
+            i = self.vocab.get(word)
+            if i is None:
+                i = self.vocab[word] = len(self.vocab_words)
+                self.vocab_words.append(word)
+            features[j] = i
+        self.features_dict[date] = features
+        self.dtm_dict[date] = count_vecs.astype(np.int32)
+
+    def build_top_index(self, k=20):
+        """
+        Build the index of the top k words of every NMF topic of every day, see TopicIndex. Once built, the
+        index is updated with the days added by fit() and append_days()
+
+        Parameters:
+            k: int, optional
+                Number of top words per topic
+        Returns:
+            TopicIndex
+        """
+        self.top_index = TopicIndex(k)
+        for date in sorted(self.nmf_dict):
+            self.top_index.add(date, self.get_feature_names(date), self.nmf_dict[date].components_)
+
+        return self.top_index
+
+    def get_feature_names(self, date):
+        """
+        Words of the columns of a day's TF-IDF and count matrices, same as get_feature_names() of the
+        day's vectorizers
+
+        Parameters:
+            date: string
+                Date in 'yyyy-mm-dd' format
+        Returns:
+            List[str]
+        """
+        if self.shared_vocab:
+            return [self.vocab_words[i] for i in self.features_dict[date]]
+
+        return _vectorizer_words(self.tfidf_dict[date])
+
+    def project(self, date, onto_date):
+        """
+        Count matrix of a day with the columns of another day, dropping words that aren't in the other
+        day's vocabulary. Only available with shared_vocab=True
+
+        Parameters:
+            date: string
+                Date in 'yyyy-mm-dd' format of the count matrix
+            onto_date: string
+                Date in 'yyyy-mm-dd' format whose columns are used
+        Returns:
+            scipy sparse matrix
+        """
+        onto_features = self.features_dict[onto_date]
+        lookup = np.full(len(self.vocab_words), -1, dtype=np.int64)
+        lookup[onto_features] = np.arange(len(onto_features))
+        columns = lookup[self.features_dict[date]]
+
+        count_vecs = self.dtm_dict[date]
+        entry_columns = columns[count_vecs.indices]
+        kept = entry_columns >= 0
+        indptr = np.concatenate([[0], np.cumsum(kept)])[count_vecs.indptr]
+        projected = csr_matrix((count_vecs.data[kept].astype(np.float64), entry_columns[kept], indptr),
+                               shape=(count_vecs.shape[0], len(onto_features)))
+        # Same index order as CountVectorizer.transform()
+        projected.sort_indices()
+
+        return projected
+
+    def append_days(self, df, date_range, warm_start=False, online_lda=False, warm_max_iter=50, n_jobs=1):
+        """
+        Fit NMF and LDA models only for the days in date_range that haven't been fitted yet
+
+        Parameters:
+            df: Pandas DataFrame or str
+                Data for a particular date range for the output of read_raw_data() method in modules.tweet_data,
+                or path to a tweet store, from which only the tweets in date_range are read
+            date_range: DateTimeIndex
+                DateTimeIndex of dates which will serve as range for fitting the data
+            warm_start: bool, optional
+                If True, each day's NMF model starts from the previous day's topics instead of from scratch,
+                which needs fewer iterations since consecutive days share most of their topics
+            online_lda: bool, optional
+                If True, each day's LDA model is an online update of the previous day's model
+            warm_max_iter: int, optional
+                Maximum number of iterations of warm started NMF models
+            n_jobs: int, optional
+                Number of worker processes, only used if warm_start and online_lda are False, since warm
+                started days depend on each other. If None, uses the number of CPUs
+        Returns:
+            List[str]
+                Dates that were fitted
+        """
+        if isinstance(df, str):
+            df = read_raw_data(df, start=date_range[0], end=date_range[-1], columns=['tweet'])
+
+        windows = [window for window in self._day_windows(df, date_range) if window[0] not in self.nmf_dict]
+
+        if not warm_start and not online_lda:
+            self._fit_windows(windows, n_jobs)
+        else:
+            # Each day is stored before the next one is fitted, so it can start from the previous day
+            self._store_days(self._fit_day(window,
+                                           nmf_init_date=self._previous_date(window[0]) if warm_start else None,
+                                           lda_init_date=self._previous_date(window[0]) if online_lda else None,
+                                           max_iter=warm_max_iter)
+                             for window in windows)
 
         print("\nFinished")
 
+        return [str_date for str_date, _ in windows]
+
+    def _previous_date(self, date):
+        """
+        Latest fitted date before date, or None if there isn't any
+        """
+        previous = [d for d in self.nmf_dict if d < date]
+
+        return max(previous) if previous else None
+
     def calc_rec_error(self, df, date_range):
         """
         Calculate reconstruction error. For the data of one trading day, take previous day's NMF
         model, apply transform method to the data, and calculate reconstruction error
         Parameters:
-            df: Pandas DataFrame
-                Data for a particular date range for the output of read_raw_data() method in modules.tweet_data
+            df: Pandas DataFrame or str
+                Data for a particular date range for the output of read_raw_data() method in modules.tweet_data,
+                or path to a tweet store, from which only the tweets in date_range are read
             date_range: DateTimeIndex
                 DateTimeIndex of dates which will serve as range for fitting the data
 
@@ -113,6 +427,8 @@ class TopicSeries:
                 List of reconstruction errors for the fitted models
                 List of reconstruction errors for the transformed data
         """
+        if isinstance(df, str):
+            df = read_raw_data(df, start=date_range[0], end=date_range[-1], columns=['tweet'])
 
         model_err = []
         new_err = []
@@ -122,19 +438,17 @@ class TopicSeries:
             prev_str_date = str(date_range[i].date())
             print("Working on : ", str_date, end="\r")
 
-            # Take portion of df in the range of a trading day
-            sub_df = df[date_range[i]:(date_range[i + 1] - dt.timedelta(seconds=1))].tweet
-            # Tokenize with Spacy NLP pipe. Disable tagger, parser and ner for faster calculation
-            sub_df = [self.twitter_tokenizer(text) for text in nlp.pipe(sub_df, disable=["tagger", "parser", "ner"])]
-            # Use previous day's tfidf model to transform data to tfidf format used to fit NMF model
-            tfidf_vecs = self.tfidf_dict[prev_str_date].transform(sub_df)
-            # Calculate reconstruction error using method from
-            # https://github.com/scikit-learn/scikit-learn/blob/master/sklearn/decomposition/_nmf.py
-            new_rec_err = _beta_divergence(tfidf_vecs,
-                                           self.nmf_dict[prev_str_date].transform(tfidf_vecs),
-                                           self.nmf_dict[prev_str_date].components_,
-                                           'frobenius',
-                                           square_root=True)
+            if self.shared_vocab:
+                # Remap the stored counts to the previous day's words instead of tokenizing again
+                tfidf_vecs = self.tfidf_dict[prev_str_date].transform(self.project(str_date, prev_str_date),
+                                                                      copy=False)
+            else:
+                # Take portion of df in the range of a trading day
+                sub_df = df[date_range[i]:(date_range[i + 1] - dt.timedelta(seconds=1))].tweet
+                sub_df = self.tokenize(str_date, sub_df)
+                # Use previous day's tfidf model to transform data to tfidf format used to fit NMF model
+                tfidf_vecs = self.tfidf_dict[prev_str_date].transform(sub_df)
+            new_rec_err = transform_error(self.nmf_dict[prev_str_date], tfidf_vecs)
             # Reconstruction error from original model
             rec_err = self.nmf_dict[str_date].reconstruction_err_
 
@@ -145,10 +459,185 @@ class TopicSeries:
 
         return model_err, new_err
 
+    def tokenize(self, date, tweets):
+        """
+        Tokenize the tweets of a trading day with Spacy NLP pipe and twitter_tokenizer(). If the TopicSeries
+        has a token cache, days whose tweets and tokenizer settings haven't changed are loaded from it
+
+        Parameters:
+            date: string
+                Date in 'yyyy-mm-dd' format
+            tweets: pandas Series[str]
+                Tweets of the trading day
+        Returns:
+            List[List[str]]
+                List of tokens per tweet
+        """
+        if self.token_cache is not None:
+            flags = {name: parameter.default
+                     for name, parameter in inspect.signature(self.twitter_tokenizer).parameters.items()
+                     if name != 'doc'}
+            flags.update(self.tokenizer_flags)
+            key = self.token_cache.key(tweets, model=DEFAULT_MODEL, versions=model_versions(DEFAULT_MODEL),
+                                       **flags)
+            docs = self.token_cache.load(date, key)
+            if docs is not None:
+                return docs
+
+        tokenizer = self.array_tokenizer if self.tokenizer_backend == 'array' else self.twitter_tokenizer
+        # Tokenize with Spacy NLP pipe. Disable tagger, parser and ner for faster calculation
+        docs = [tokenizer(text, **self.tokenizer_flags)
+                for text in get_nlp().pipe(tweets, disable=["tagger", "parser", "ner"])]
+
+        if self.token_cache is not None:
+            self.token_cache.save(date, key, docs)
+
+        return docs
+
     def save(self, file_path='data/topics.p'):
 
         pickle.dump(self, open(file_path, "wb"))
 
+    def save_compact(self, directory='data/topics'):
+        """
+        Save the series in a compact format that load_compact() opens lazily: a manifest with the settings
+        and dates, and a folder per date with the topic components as float32 arrays and the vocabulary
+        and IDF weights of the day as arrays. Fitted vectorizers and models aren't pickled. The series is written
+        to a temporary directory that then replaces directory, so a series opened with load_compact() can be
+        saved back to the directory its arrays are memory mapped from
+
+        Parameters:
+            directory: string, optional
+                Directory where the series is written to
+        """
+        dates = sorted(self.nmf_dict)
+        manifest = {'n_components': self.n_components,
+                    'random_state': self.random_state,
+                    'tokenizer_flags': self.tokenizer_flags,
+                    'tokenizer_backend': self.tokenizer_backend,
+                    'shared_vocab': self.shared_vocab,
+                    'dates': dates,
+                    'nmf': {},
+                    'lda': {},
+                    'dtm_shape': {}}
+
+        target = directory
+        directory = target.rstrip(os.sep) + '.tmp'
+        if os.path.exists(directory):
+            shutil.rmtree(directory)
+        os.makedirs(directory)
+        if self.shared_vocab:
+            np.save(os.path.join(directory, 'vocab.npy'), np.array(self.vocab_words, dtype=str))
+
+        for date in dates:
+            print("Working on : ", date, end="\r")
+            day_dir = os.path.join(directory, date)
+            os.makedirs(day_dir, exist_ok=True)
+
+            if self.shared_vocab:
+                np.save(os.path.join(day_dir, 'features.npy'), self.features_dict[date])
+                dtm = self.dtm_dict[date]
+                for name in ['data', 'indices', 'indptr']:
+                    np.save(os.path.join(day_dir, 'dtm_{}.npy'.format(name)), getattr(dtm, name))
+                manifest['dtm_shape'][date] = list(dtm.shape)
+            else:
+                np.save(os.path.join(day_dir, 'words.npy'), np.array(self.get_feature_names(date), dtype=str))
+            # IDF weights stay float64, so TF-IDF matrices are the same as before saving
+            np.save(os.path.join(day_dir, 'idf.npy'), self.tfidf_dict[date].idf_)
+
+            nmf = self.nmf_dict[date]
+            np.save(os.path.join(day_dir, 'nmf.npy'), nmf.components_.astype(np.float32))
+            manifest['nmf'][date] = {'reconstruction_err': float(nmf.reconstruction_err_),
+                                     'n_iter': int(nmf.n_iter_)}
+
+            lda = self.lda_dict[date]
+            np.save(os.path.join(day_dir, 'lda.npy'), lda.components_.astype(np.float32))
+            # State of the random generator, so online updates of a loaded model continue the same way
+            _, keys, pos, has_gauss, cached_gaussian = lda.random_state_.get_state()
+            np.save(os.path.join(day_dir, 'lda_random_state.npy'), keys)
+            manifest['lda'][date] = {'doc_topic_prior': float(lda.doc_topic_prior_),
+                                     'topic_word_prior': float(lda.topic_word_prior_),
+                                     'n_batch_iter': int(lda.n_batch_iter_),
+                                     'n_iter': int(lda.n_iter_),
+                                     'random_state': [int(pos), int(has_gauss), float(cached_gaussian)]}
+
+        # Manifest is written last, so an interrupted save is never mistaken for a complete one
+        with open(os.path.join(directory, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f)
+
+        # Memory maps of the previous files stay valid after they are renamed and deleted
+        old = target.rstrip(os.sep) + '.old'
+        if os.path.exists(old):
+            shutil.rmtree(old)
+        if os.path.exists(target):
+            os.replace(target, old)
+        os.replace(directory, target)
+        if os.path.exists(old):
+            shutil.rmtree(old)
+
+        print("\nFinished")
+
+    def _load_day_array(self, date, name):
+        # Read only memory map, only the pages that are used are read from disk
+        return np.load(os.path.join(self.compact_dir, date, name + '.npy'), mmap_mode='r')
+
+    def _load_features(self, date):
+        # Vocabulary ids are small and used in lookups, so they are read into memory
+        return np.array(self._load_day_array(date, 'features'))
+
+    def _load_words(self, date):
+        if self.shared_vocab:
+            return [self.vocab_words[i] for i in self._load_day_array(date, 'features')]
+
+        return self._load_day_array(date, 'words').tolist()
+
+    def _load_tfidf(self, date):
+        if self.shared_vocab:
+            tfidf = TfidfTransformer()
+            tfidf.idf_ = np.array(self._load_day_array(date, 'idf'))
+            tfidf.n_features_in_ = len(tfidf.idf_)
+            return tfidf
+
+        tfidf = TfidfVectorizer(tokenizer=self.tokenizer, lowercase=False)
+        tfidf.vocabulary_ = {word: i for i, word in enumerate(self._load_words(date))}
+        tfidf.idf_ = np.array(self._load_day_array(date, 'idf'))
+        return tfidf
+
+    def _load_cv(self, date):
+        cv = CountVectorizer(tokenizer=self.tokenizer, lowercase=False)
+        cv.vocabulary_ = {word: i for i, word in enumerate(self._load_words(date))}
+        cv.fixed_vocabulary_ = False
+        return cv
+
+    def _load_nmf(self, date):
+        params = self.compact_manifest['nmf'][date]
+        nmf = NMF(n_components=self.n_components, random_state=self.random_state)
+        nmf.components_ = self._load_day_array(date, 'nmf')
+        nmf.n_components_, nmf.n_features_in_ = nmf.components_.shape
+        nmf.reconstruction_err_ = params['reconstruction_err']
+        nmf.n_iter_ = params['n_iter']
+        return nmf
+
+    def _load_lda(self, date):
+        params = self.compact_manifest['lda'][date]
+        lda = LatentDirichletAllocation(n_components=self.n_components, random_state=self.random_state)
+        lda.components_ = self._load_day_array(date, 'lda')
+        lda.n_features_in_ = lda.components_.shape[1]
+        lda.exp_dirichlet_component_ = np.exp(psi(lda.components_) - psi(lda.components_.sum(axis=1))[:, np.newaxis])
+        lda.doc_topic_prior_ = params['doc_topic_prior']
+        lda.topic_word_prior_ = params['topic_word_prior']
+        lda.n_batch_iter_ = params['n_batch_iter']
+        lda.n_iter_ = params['n_iter']
+        lda.random_state_ = check_random_state(None)
+        lda.random_state_.set_state(('MT19937', np.array(self._load_day_array(date, 'lda_random_state')),
+                                     *params['random_state']))
+        return lda
+
+    def _load_dtm(self, date):
+        return csr_matrix(tuple(self._load_day_array(date, 'dtm_{}'.format(name))
+                                for name in ['data', 'indices', 'indptr']),
+                          shape=tuple(self.compact_manifest['dtm_shape'][date]))
+
     @staticmethod
     def tokenizer(d):
         return d
@@ -208,6 +697,422 @@ class TopicSeries:
             tokens.append(t)
         return tokens
 
+    @staticmethod
+    def array_tokenizer(doc,
+                        urls=True,
+                        stop_words=True,
+                        lowercase=True,
+                        alpha_only=True,
+                        hashtags=False,
+                        lemma=False):
+        """
+        Same tokens as twitter_tokenizer(), but the tokens to keep are selected for the whole Doc at once
+        from arrays of token attributes, see twitter_token_mask() in modules.spacy
+
+        Parameters:
+            urls: bool, optional
+                If True, remove URLs
+            stop_words: bool, optional
+                If True, removes stop words
+            lowercase: bool, optional
+                If True, lowercases all tokens
+            alpha_only: bool, optional
+                If True, removes all non-alpha characters
+            hashtags: bool, optional
+                If True, remove hashtags
+            lemma: bool, optional
+            If True, lemmatizes words
+
+        Returns:
+            List[str]
+                List of tokens
+        """
+        keep, orth = twitter_token_mask(doc, urls=urls, stop_words=stop_words, alpha_only=alpha_only,
+                                        hashtags=hashtags)
+        if lemma:
+            tokens = [doc[i].lemma_ for i in np.flatnonzero(keep)]
+        else:
+            strings = doc.vocab.strings
+            tokens = [strings[h] for h in orth[keep].tolist()]
+        if lowercase:
+            tokens = [t.lower() for t in tokens]
+        return tokens
+
+
+def load_compact(directory='data/topics'):
+    """
+    Open a TopicSeries written with TopicSeries.save_compact(). Only the manifest is read, the vectorizers
+    and models of a date are rebuilt from memory mapped arrays the first time the date is accessed
+
+    Parameters:
+        directory: string, optional
+            Directory the series was written to
+    Returns:
+        TopicSeries
+    """
+    with open(os.path.join(directory, 'manifest.json')) as f:
+        manifest = json.load(f)
+
+    ts = TopicSeries(manifest['n_components'], manifest['random_state'],
+                     tokenizer_flags=manifest['tokenizer_flags'], tokenizer_backend=manifest['tokenizer_backend'],
+                     shared_vocab=manifest['shared_vocab'])
+    ts.compact_dir = directory
+    ts.compact_manifest = manifest
+
+    dates = manifest['dates']
+    ts.tfidf_dict = LazyDayDict(dates, ts._load_tfidf)
+    ts.nmf_dict = LazyDayDict(dates, ts._load_nmf)
+    ts.lda_dict = LazyDayDict(dates, ts._load_lda)
+    if ts.shared_vocab:
+        ts.vocab_words = np.load(os.path.join(directory, 'vocab.npy')).tolist()
+        ts.vocab = {word: i for i, word in enumerate(ts.vocab_words)}
+        ts.features_dict = LazyDayDict(dates, ts._load_features)
+        ts.dtm_dict = LazyDayDict(dates, ts._load_dtm)
+    else:
+        ts.cv_dict = LazyDayDict(dates, ts._load_cv)
+
+    return ts
+
+
+class LazyDayDict(collections.abc.MutableMapping):
+    """
+    Dictionary of dates whose values are only loaded when they are first accessed. Values added after
+    creation are stored like in a normal dictionary
+    """
+    def __init__(self, dates, loader):
+        """
+        Parameters:
+            dates: List[str]
+                Dates in 'yyyy-mm-dd' format that can be loaded
+            loader: function
+                Function that returns the value of a date
+        """
+        self.dates = list(dates)
+        self._date_set = set(self.dates)
+        self._loader = loader
+        self._values = {}
+
+    def __getitem__(self, date):
+        if date not in self._values:
+            if date not in self._date_set:
+                raise KeyError(date)
+            self._values[date] = self._loader(date)
+        return self._values[date]
+
+    def __setitem__(self, date, value):
+        if date not in self._date_set:
+            self._date_set.add(date)
+            self.dates.append(date)
+        self._values[date] = value
+
+    def __delitem__(self, date):
+        if date not in self._date_set:
+            raise KeyError(date)
+        self._date_set.remove(date)
+        self.dates.remove(date)
+        self._values.pop(date, None)
+
+    def __contains__(self, date):
+        # Doesn't load the date
+        return date in self._date_set
+
+    def __reduce__(self):
+        # Pickled as a normal dictionary with every date loaded, so the pickle doesn't depend on the files the
+        # values are loaded from
+        return dict, (dict(self.items()),)
+
+    def __iter__(self):
+        return iter(self.dates)
+
+    def __len__(self):
+        return len(self.dates)
+
+
+class TopicIndex:
+    """
+    Top k words of every topic of every day of a TopicSeries, by NMF weight. Words are stored as ids into a
+    vocabulary of the words that are in any top k, in an int32 array of shape (days, topics, k), with their
+    weights in a float32 array of the same shape. The arrays have spare rows and grow by doubling, so adding
+    days in order doesn't copy them each time
+    """
+    def __init__(self, k=20):
+        """
+        Parameters:
+            k: int, optional
+                Number of top words per topic
+        """
+        self.k = k
+        self.dates = []
+        self.words = []
+        self.vocab = {}
+        self._term_ids = None
+        self._weights = None
+
+    @property
+    def term_ids(self):
+        return None if self._term_ids is None else self._term_ids[:len(self.dates)]
+
+    @property
+    def weights(self):
+        return None if self._weights is None else self._weights[:len(self.dates)]
+
+    def add(self, date, word_features, components):
+        """
+        Add or replace the topics of a day
+
+        Parameters:
+            date: string
+                Date in 'yyyy-mm-dd' format
+            word_features: List[str]
+                Words of the columns of components, output of TopicSeries.get_feature_names()
+            components: array
+                components_ of the day's NMF model
+        """
+        top = top_indices(components, self.k)
+        term_ids = np.full(top.shape, -1, dtype=np.int32)
+        weights = np.zeros(top.shape, dtype=np.float32)
+        for topic, idx in enumerate(top):
+            idx = idx[idx >= 0]
+            term_ids[topic, :len(idx)] = [self._term_id(word_features[i]) for i in idx]
+            weights[topic, :len(idx)] = components[topic, idx]
+
+        pos = bisect.bisect_left(self.dates, date)
+        if pos < len(self.dates) and self.dates[pos] == date:
+            self._term_ids[pos], self._weights[pos] = term_ids, weights
+            return
+
+        n_days = len(self.dates)
+        if self._term_ids is None or n_days == len(self._term_ids):
+            capacity = max(16, 2 * n_days)
+            new_term_ids = np.full((capacity,) + term_ids.shape, -1, dtype=np.int32)
+            new_weights = np.zeros((capacity,) + weights.shape, dtype=np.float32)
+            if n_days:
+                new_term_ids[:n_days], new_weights[:n_days] = self.term_ids, self.weights
+            self._term_ids, self._weights = new_term_ids, new_weights
+        # Days after date move one row down, nothing moves when days are added in order
+        self._term_ids[pos + 1:n_days + 1] = self._term_ids[pos:n_days]
+        self._weights[pos + 1:n_days + 1] = self._weights[pos:n_days]
+        self._term_ids[pos], self._weights[pos] = term_ids, weights
+        self.dates.insert(pos, date)
+
+    def __contains__(self, date):
+        pos = bisect.bisect_left(self.dates, date)
+        return pos < len(self.dates) and self.dates[pos] == date
+
+    def _position(self, date):
+        """
+        Row of a date, KeyError if the date isn't in the index
+        """
+        pos = bisect.bisect_left(self.dates, date)
+        if pos == len(self.dates) or self.dates[pos] != date:
+            raise KeyError(date)
+        return pos
+
+    def _term_id(self, word):
+        i = self.vocab.get(word)
+        if i is None:
+            i = self.vocab[word] = len(self.words)
+            self.words.append(word)
+        return i
+
+    def _positions(self, start=None, end=None):
+        """
+        Slice of the days between start and end, both included
+        """
+        return slice(bisect.bisect_left(self.dates, start) if start is not None else 0,
+                     bisect.bisect_right(self.dates, end) if end is not None else len(self.dates))
+
+    def top_words(self, date, top=None):
+        """
+        Top words of each topic of a day, by decreasing weight
+
+        Parameters:
+            date: string
+                Date in 'yyyy-mm-dd' format
+            top: int, optional
+                Number of words per topic, at most k. Defaults to k
+        Returns:
+            List[List[str]]
+        """
+        term_ids = self.term_ids[self._position(date), :, :top]
+
+        return [[self.words[i] for i in topic if i >= 0] for topic in term_ids]
+
+    def top_weights(self, date, top=None):
+        """
+        Weights of the top words of each topic of a day, same shape as top_words()
+
+        Returns:
+            List[List[float]]
+        """
+        i = self._position(date)
+
+        return [weights[term_ids >= 0].tolist()
+                for term_ids, weights in zip(self.term_ids[i, :, :top], self.weights[i, :, :top])]
+
+    def days_with_term(self, term, start=None, end=None, top=None):
+        """
+        Days on which a word is in the top words of any topic, for example
+        ts.top_index.days_with_term('#coronavirus', '2020-01-01', '2020-05-01')
+
+        Parameters:
+            term: string
+            start: string, optional
+                First date in 'yyyy-mm-dd' format
+            end: string, optional
+                Last date in 'yyyy-mm-dd' format
+            top: int, optional
+                Only count the top words of each topic, at most k. Defaults to k
+        Returns:
+            List[str]
+        """
+        term_id = self.vocab.get(term)
+        if term_id is None:
+            return []
+        days = self._positions(start, end)
+        found = (self.term_ids[days, :, :top] == term_id).any(axis=(1, 2))
+
+        return [self.dates[days.start + i] for i in np.flatnonzero(found)]
+
+
+def transform_error(nmf, tfidf_vecs):
+    """
+    Reconstruction error of data transformed with a fitted NMF model
+
+    Parameters:
+        nmf: NMF model
+        tfidf_vecs: scipy sparse matrix
+            TF-IDF matrix with the columns the model was fitted on
+    Returns:
+        float
+    """
+    # Components of a series opened with load_compact() are float32
+    tfidf_vecs = tfidf_vecs.astype(nmf.components_.dtype, copy=False)
+    # Calculate reconstruction error using method from
+    # https://github.com/scikit-learn/scikit-learn/blob/master/sklearn/decomposition/_nmf.py
+    return _beta_divergence(tfidf_vecs, nmf.transform(tfidf_vecs), nmf.components_, 'frobenius', square_root=True)
+
+
+def top_indices(components, k):
+    """
+    Columns of the k largest weights of each row of components, by decreasing weight, found with a partial
+    selection instead of a full sort. Ties are broken by the higher column first, the order of
+    argsort(kind='stable')[::-1]. The argsort() with the default quicksort used before doesn't define the
+    order of ties, so words of equal weight can be listed in a different order than before
+
+    Parameters:
+        components: array
+            components_ of a topic model
+        k: int
+            Number of columns per row
+    Returns:
+        array
+            Shape (rows, k), padded with -1 if there are fewer than k columns
+    """
+    n_rows, n_cols = components.shape
+    top = np.full((n_rows, k), -1, dtype=np.int64)
+    if n_cols == 0:
+        return top
+    kth = min(k, n_cols)
+    for row, topic in enumerate(components):
+        # Everything at least as large as the k-th largest weight, then ordered by weight and column
+        candidates = np.flatnonzero(topic >= np.partition(topic, n_cols - kth)[n_cols - kth])
+        order = np.lexsort((-candidates, -topic[candidates]))[:kth]
+        top[row, :kth] = candidates[order]
+
+    return top
+
+
+def _vectorizer_words(vectorizer):
+    """
+    Words of a fitted CountVectorizer or TfidfVectorizer, in column order
+    """
+    return sorted(vectorizer.vocabulary_, key=vectorizer.vocabulary_.get)
+
+
+def _count_matrix(data):
+    """
+    Count matrix of tokenized tweets, same as CountVectorizer.fit_transform()
+
+    Parameters:
+        data: List[List[str]]
+            Tokens per tweet
+    Returns:
+        List[str], scipy sparse matrix
+            Words in column order, count matrix
+    """
+    cv = CountVectorizer(tokenizer=TopicSeries.tokenizer, lowercase=False)
+    count_vecs = cv.fit_transform(data)
+
+    return _vectorizer_words(cv), count_vecs
+
+
+def _map_components(components, old_words, new_words, fill):
+    """
+    Map topic components fitted on one vocabulary onto another vocabulary
+
+    Parameters:
+        components: array
+            components_ of a topic model, one column per word of old_words
+        old_words: List[str]
+            Words components was fitted on, in column order
+        new_words: List[str]
+            Target vocabulary, in column order
+        fill: float
+            Value for words that aren't in old_words
+    Returns:
+        array
+            One row per topic, one column per word of new_words
+    """
+    old_vocab = {word: i for i, word in enumerate(old_words)}
+    old_cols = np.fromiter((old_vocab.get(word, -1) for word in new_words), dtype=np.int64, count=len(new_words))
+    shared = old_cols >= 0
+
+    mapped = np.full((components.shape[0], len(new_words)), fill, dtype=components.dtype)
+    mapped[:, shared] = components[:, old_cols[shared]]
+
+    return mapped
+
+
+# TopicSeries used by the worker processes of TopicSeries.fit()
+_worker_series = None
+
+
+def _init_worker(series):
+    global _worker_series
+    _worker_series = series
+    # One BLAS thread per worker process, parallelism comes from fitting several days at once
+    threadpool_limits(1)
+
+
+def _fit_day_worker(window):
+    return _worker_series._fit_day(window)
+
+
+def _ordered_imap(pool, func, iterable, max_pending):
+    """
+    Like pool.imap, but only submits up to max_pending items of iterable at a time, so that memory use
+    doesn't grow with the length of iterable
+
+    Parameters:
+        pool: multiprocessing Pool
+        func: function
+            Function applied to each item, must be picklable
+        iterable: iterable
+            Input items
+        max_pending: int
+            Maximum number of submitted items whose result hasn't been returned yet
+    Yields:
+        Results of func, in the order of iterable
+    """
+    pending = collections.deque()
+    for item in iterable:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
 
 def display_components(model, word_features, top_display=5):
     """
@@ -220,8 +1125,7 @@ def display_components(model, word_features, top_display=5):
         top_display: int, optional
             Number of words per topic displayed
     """
-    for topic_idx, topic in enumerate(model.components_):
+    for topic_idx, top_words_idx in enumerate(top_indices(model.components_, top_display)):
         print("Topic {}:".format(topic_idx))
-        top_words_idx = topic.argsort()[::-1][:top_display]
-        top_words = [word_features[i] for i in top_words_idx]
+        top_words = [word_features[i] for i in top_words_idx if i >= 0]
         print(" ".join(top_words))
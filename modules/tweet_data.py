@@ -1,6 +1,13 @@
 import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
 from collections import Counter
 import re
+import os
+import shutil
+import multiprocessing
 
 pd.options.mode.chained_assignment = None  # default='warn'
 
@@ -11,27 +18,162 @@ REGEX_DICT = {'link': "http\S+",
               'email': "[a-zA-Z0-9+._-]+@[a-zA-Z0-9._-]+\.[a-zA-Z0-9_-]+",
               'add': "\s([@][\w_-]+)|[@][\w_-]+"}
 
+# REGEX_DICT patterns compiled once, in the same order, each with a literal substring it can't match without
+CLEAN_PATTERNS = [(literal, re.compile(REGEX_DICT[key])) for key, literal in [('link', 'http'),
+                                                                             ('piclink', 'twitter'),
+                                                                             ('hashtag', '#'),
+                                                                             ('email', '@'),
+                                                                             ('add', '@')]]
+NON_ALNUM_PATTERN = re.compile(r'[^a-zA-Z0-9]')
 
-def read_raw_data(file='data/tweets.csv'):
+
+def read_raw_data(file='data/tweets.csv', start=None, end=None, handles=None, columns=None):
     """
-    Read csv file with raw tweet data
+    Read csv file or tweet store with raw tweet data
 
     Parameters:
         file: str, optional
-            CSV file path
+            CSV file path, or directory of a tweet store created with to_tweet_store()
+        start: str or datetime, optional
+            Only read tweets with timestamp >= start
+        end: str or datetime, optional
+            Only read tweets with timestamp <= end
+        handles: list, optional
+            Only read tweets from these handles
+        columns: list, optional
+            Columns to read besides the timestamp index. Defaults to all columns
     Returns:
         pandas DataFrame
     """
 
     print("Reading data")
 
-    data = pd.read_csv(file, index_col=['timestamp'], parse_dates=True)
+    if os.path.isdir(file):
+        return read_tweet_store(file, start=start, end=end, handles=handles, columns=columns)
+
+    usecols = None
+    if columns is not None:
+        columns = [c for c in columns if c != 'timestamp']
+        usecols = ['timestamp'] + list(dict.fromkeys(columns + (['handle'] if handles is not None else [])))
+    data = pd.read_csv(file, index_col=['timestamp'], parse_dates=True, usecols=usecols)
     # Drop NAs
     data.dropna(inplace=True)
 
+    if start is not None:
+        data = data[data.index >= pd.Timestamp(start)]
+    if end is not None:
+        data = data[data.index <= pd.Timestamp(end)]
+    if handles is not None:
+        data = data[data.handle.isin(handles)]
+    if columns is not None:
+        data = data[columns]
+
     return data
 
 
+def to_tweet_store(file='data/tweets.csv', store_path='data/tweets_store', chunksize=1000000, overwrite=False):
+    """
+    Convert csv file with raw tweet data into a Parquet dataset partitioned by date, so that
+    read_tweet_store() only needs to read the days and columns it uses
+
+    Parameters:
+        file: str, optional
+            CSV file path
+        store_path: str, optional
+            Directory where the dataset will be written to. One sub-directory per date, date=yyyy-mm-dd
+        chunksize: int, optional
+            Number of rows of the csv file processed at a time
+        overwrite: bool, optional
+            If True, an existing store at store_path is deleted first. Otherwise writing into a non empty
+            directory raises ValueError, since the new files would be added to the existing ones and every
+            tweet would be read twice
+    """
+
+    if os.path.isdir(store_path) and os.listdir(store_path):
+        if not overwrite:
+            raise ValueError("{} is not empty, pass overwrite=True to replace it".format(store_path))
+        print("Deleting existing tweet store", store_path)
+        shutil.rmtree(store_path)
+
+    for i, chunk in enumerate(pd.read_csv(file, parse_dates=['timestamp'], dtype={'handle': str, 'tweet': str},
+                                          chunksize=chunksize)):
+        print("Writing chunk", i, end="\r")
+        # Drop NAs
+        chunk.dropna(inplace=True)
+        chunk['date'] = chunk.timestamp.dt.strftime('%Y-%m-%d')
+        pq.write_to_dataset(pa.Table.from_pandas(chunk, preserve_index=False), store_path, partition_cols=['date'])
+
+    print("\nFrom csv to tweet store successful")
+
+
+def open_tweet_store(store_path='data/tweets_store'):
+    """
+    Open a Parquet dataset created with to_tweet_store(), discovering its date partitions
+
+    Parameters:
+        store_path: str, optional
+            Directory of the dataset
+    Returns:
+        pyarrow Dataset
+    """
+
+    return ds.dataset(store_path, format='parquet',
+                      partitioning=ds.partitioning(pa.schema([('date', pa.string())]), flavor='hive'))
+
+
+def read_tweet_store(store_path='data/tweets_store', start=None, end=None, handles=None, columns=None,
+                     dataset=None):
+    """
+    Read tweet data from a Parquet dataset created with to_tweet_store(). Only the date partitions
+    between start and end and the requested columns are read from disk
+
+    Parameters:
+        store_path: str, optional
+            Directory of the dataset
+        start: str or datetime, optional
+            Only read tweets with timestamp >= start
+        end: str or datetime, optional
+            Only read tweets with timestamp <= end
+        handles: list, optional
+            Only read tweets from these handles
+        columns: list, optional
+            Columns to read besides the timestamp index. Defaults to all columns
+        dataset: pyarrow Dataset, optional
+            Output of open_tweet_store(store_path), so that many reads don't each discover the partitions
+    Returns:
+        pandas DataFrame
+    """
+
+    if dataset is None:
+        dataset = open_tweet_store(store_path)
+
+    # Filters on the date partition key skip whole directories, filters on timestamp trim the edge days
+    filters = []
+    if start is not None:
+        start = pd.Timestamp(start)
+        filters += [ds.field('date') >= str(start.date()), ds.field('timestamp') >= start.to_pydatetime()]
+    if end is not None:
+        end = pd.Timestamp(end)
+        filters += [ds.field('date') <= str(end.date()), ds.field('timestamp') <= end.to_pydatetime()]
+    if handles is not None:
+        filters.append(ds.field('handle').isin(list(handles)))
+
+    if columns is None:
+        columns = [name for name in dataset.schema.names if name not in ('timestamp', 'date')]
+    # tweet_id is always read to sort tweets the same way as the csv file
+    read_columns = ['timestamp'] + list(dict.fromkeys(['tweet_id'] + [c for c in columns if c != 'timestamp']))
+
+    data_filter = None
+    for f in filters:
+        data_filter = f if data_filter is None else data_filter & f
+
+    data = dataset.to_table(columns=read_columns, filter=data_filter).to_pandas()
+    data.sort_values(by=['timestamp', 'tweet_id'], inplace=True)
+    data.set_index('timestamp', inplace=True)
+
+    return data[[c for c in columns if c != 'timestamp']]
+
+
 def remove_timestamp_tweet_id_mismatch(input_file='data/tweets.csv', output_file='data/tweets.csv'):
     """
     Remove tweets whose tweet_id order doesn't match with the timestamp order
@@ -52,55 +194,113 @@ def remove_timestamp_tweet_id_mismatch(input_file='data/tweets.csv', output_file
     tweets_df.to_csv(output_file, index=False)
 
 
-def clean_sentiment(tweets):
+def _clean_tweet(tweet, alnum_only=False):
     """
-    Remove links, hashtags, emails and @s from tweets, and covert to lowercase
+    Apply all cleaning rules to one tweet in a single pass
+
+    Parameters:
+        tweet: str
+            Raw tweet
+        alnum_only: bool, optional
+            If True, also remove apostrophes and replace symbols other than letters and numbers with spaces
+    Returns:
+        str
+    """
+    # Remove links, hashtags, emails, @s. A pattern is only run if the literal text it needs is in the tweet
+    for literal, pattern in CLEAN_PATTERNS:
+        if literal in tweet:
+            tweet = pattern.sub('', tweet)
+    # Turn everything to lower case
+    tweet = tweet.lower()
+    if alnum_only:
+        # Remove symbols other than letters in the alphabet and numbers
+        tweet = tweet.replace("'", '')
+        tweet = NON_ALNUM_PATTERN.sub(' ', tweet)
+
+    return tweet
+
+
+def _clean_chunk(args):
+    """
+    Clean a list of tweets. Worker function for clean_tweets()
+
+    Parameters:
+        args: tuple
+            (list of tweets, alnum_only)
+    Returns:
+        List[str]
+    """
+    tweets, alnum_only = args
+
+    return [_clean_tweet(tweet, alnum_only) for tweet in tweets]
+
+
+def clean_tweets(tweets, alnum_only=False, n_jobs=None, chunk_size=100000):
+    """
+    Remove links, hashtags, emails and @s from tweets, and convert to lowercase. All rules are applied to
+    each tweet in one pass, with chunks of the Series cleaned in parallel worker processes
 
     Parameters:
         tweets: pandas Series[str]
             Series of tweets
+        alnum_only: bool, optional
+            If True, also remove symbols other than letters and numbers, as in get_clean_data()
+        n_jobs: int, optional
+            Number of worker processes. Defaults to the number of CPUs
+        chunk_size: int, optional
+            Number of tweets per chunk sent to a worker
     Returns:
         pandas Series[str]
     """
 
-    for key, value in REGEX_DICT.items():
-        print('Filtering', key)
-        tweets = tweets.apply(lambda tweet: re.sub(value, '', tweet))
+    print("Cleaning tweets")
+
+    values = tweets.to_list()
+    chunks = [(values[i:i + chunk_size], alnum_only) for i in range(0, len(values), chunk_size)]
+
+    if n_jobs == 1 or len(chunks) <= 1:
+        cleaned = [_clean_chunk(chunk) for chunk in chunks]
+    else:
+        with multiprocessing.Pool(n_jobs) as pool:
+            cleaned = pool.map(_clean_chunk, chunks)
+
+    return pd.Series([tweet for chunk in cleaned for tweet in chunk], index=tweets.index, name=tweets.name,
+                     dtype=tweets.dtype)
 
-    tweets = tweets.str.lower()
 
-    return tweets
+def clean_sentiment(tweets, n_jobs=None):
+    """
+    Remove links, hashtags, emails and @s from tweets, and covert to lowercase
+
+    Parameters:
+        tweets: pandas Series[str]
+            Series of tweets
+        n_jobs: int, optional
+            Number of worker processes. Defaults to the number of CPUs
+    Returns:
+        pandas Series[str]
+    """
+
+    return clean_tweets(tweets, n_jobs=n_jobs)
 
 
-def get_clean_data(file='data/tweets.csv'):
+def get_clean_data(file='data/tweets.csv', n_jobs=None):
     """
     Reads csv file with raw tweet data and returns a DataFrame with tweets parsed and cleaned
 
     Parameters:
         file: str, optional
             CSV file path
+        n_jobs: int, optional
+            Number of worker processes. Defaults to the number of CPUs
     Returns:
         pandas DataFrame
     """
 
-    def clean(tweet):
-        # Turn everything to lower case
-        tweet = tweet.lower()
-        # Remove symbols other than letters in the alphabet and numbers
-        tweet = re.sub(r"\'", '', tweet)
-        tweet = re.sub(r'[^a-zA-Z0-9]', ' ', tweet)
-
-        return tweet
-
     tweet_data = read_raw_data(file)
 
-    # Remove links, hashtags, emails, @s
-    for key, value in REGEX_DICT.items():
-        print('Filtering', key)
-        tweet_data.tweet = tweet_data.tweet.apply(lambda tweet: re.sub(value, '', tweet))
-
-    print("Cleaning tweets")
-    tweet_data.tweet = tweet_data.tweet.apply(clean)
+    # Remove links, hashtags, emails, @s and symbols other than letters and numbers
+    tweet_data.tweet = clean_tweets(tweet_data.tweet, alnum_only=True, n_jobs=n_jobs)
 
     return tweet_data
 
@@ -155,3 +355,86 @@ def create_int_words(text, vocab_to_int):
     words = text.split()
 
     return [vocab_to_int[word] for word in words]
+
+
+def tweet_chunks(tweets, chunk_size=100000):
+    """
+    Split tweets in chunks for create_vocab() and encode_words()
+
+    Parameters:
+        tweets: pandas Series[str] or list
+            Tweets
+        chunk_size: int, optional
+            Number of tweets per chunk
+    Returns:
+        generator of pandas Series[str] or list
+    """
+    for i in range(0, len(tweets), chunk_size):
+        yield tweets[i:i + chunk_size]
+
+
+def create_vocab(chunks, min_count=1, max_size=None):
+    """
+    Lookup tables of create_lookup_tables() built chunk by chunk, without joining all tweets in one string.
+    Words are counted one chunk at a time, and only the counts are kept. Without pruning the tables are the
+    same as create_lookup_tables(create_text(tweet_data)), ties in frequency are in order of first appearance
+
+    Parameters:
+        chunks: iterable of pandas Series[str] or lists
+            Chunks of tweets, for instance tweet_chunks(tweet_data.tweet)
+        min_count: int, optional
+            Words appearing less than min_count times are left out
+        max_size: int, optional
+            Keep only the max_size most frequent words
+    Returns:
+        dict, dict
+            int_to_vocab and vocab_to_int
+    """
+
+    print("Creating lookup tables")
+
+    word_counts = Counter()
+    for chunk in chunks:
+        word_counts.update(' '.join(chunk).split())
+    # words sorted in descending frequency
+    sorted_vocab = sorted((word for word, count in word_counts.items() if count >= min_count),
+                          key=word_counts.get, reverse=True)[:max_size]
+    int_to_vocab = {ii: word for ii, word in enumerate(sorted_vocab)}
+    vocab_to_int = {word: ii for ii, word in int_to_vocab.items()}
+
+    return int_to_vocab, vocab_to_int
+
+
+def encode_words(chunks, vocab_to_int, output_file=None):
+    """
+    Integer encoded words of the tweets, as create_int_words() but written chunk by chunk to an int32 array.
+    Words not in vocab_to_int, those pruned by create_vocab(), are skipped
+
+    Parameters:
+        chunks: iterable of pandas Series[str] or lists
+            Chunks of tweets, in the same order as for create_vocab()
+        vocab_to_int: dict
+            Lookup table from create_vocab() or create_lookup_tables()
+        output_file: string, optional
+            If given, the words are written to this file and returned as a read only memory mapped array
+    Returns:
+        numpy array or numpy memmap of int32
+    """
+
+    def encoded_chunks():
+        for chunk in chunks:
+            words = ' '.join(chunk).split()
+            ids = np.fromiter((vocab_to_int.get(word, -1) for word in words), dtype=np.int32, count=len(words))
+            yield ids[ids >= 0]
+
+    if output_file:
+        with open(output_file, 'wb') as f:
+            for ids in encoded_chunks():
+                f.write(ids.tobytes())
+        if os.path.getsize(output_file) == 0:
+            # An empty file can't be memory mapped
+            return np.zeros(0, dtype=np.int32)
+        return np.memmap(output_file, dtype=np.int32, mode='r')
+
+    encoded = list(encoded_chunks())
+    return np.concatenate(encoded) if encoded else np.zeros(0, dtype=np.int32)
@@ -20,11 +20,18 @@ using a masked language modeling (MLM) loss. XLNet is fine-tuned using a permuta
 """
 
 
+import json
 import logging
 import math
 import os
+import time
 from dataclasses import dataclass, field
-from typing import Optional
+from typing import Dict, Iterable, Iterator, List, Optional
+
+import numpy as np
+import torch
+from torch.nn.utils.rnn import pad_sequence
+from torch.utils.data import DataLoader, Dataset, RandomSampler, Sampler
 
 from transformers import (
     CONFIG_MAPPING,
@@ -123,10 +130,372 @@ class DataTrainingArguments:
     overwrite_cache: bool = field(
         default=False, metadata={"help": "Overwrite the cached training and evaluation sets"}
     )
+    train_token_file: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": "Optional prefix of a pre-tokenized training set, read with a memory map instead of tokenizing "
+            "train_data_file on every run. Built from train_data_file if it doesn't exist."
+        },
+    )
+    eval_token_file: Optional[str] = field(
+        default=None,
+        metadata={"help": "Optional prefix of a pre-tokenized evaluation set, built from eval_data_file if needed."},
+    )
+    corpora: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": "Comma separated names of the corpora (e.g. handles) of the token files to use. "
+            "Defaults to all corpora."
+        },
+    )
+    bucket_by_length: bool = field(
+        default=False,
+        metadata={
+            "help": "With --line_by_line, batch sequences of similar length together and pad each batch only to its "
+            "longest sequence."
+        },
+    )
+    pack_lines: bool = field(
+        default=False,
+        metadata={
+            "help": "With --line_by_line, concatenate consecutive lines into sequences of up to block_size tokens, "
+            "separated by the end of sequence token. A sequence never spans two --corpora."
+        },
+    )
+
+
+def read_lines(file_path: str) -> Iterable[str]:
+    """
+    Non empty lines of a text file, split with str.splitlines() like LineByLineTextDataset, without reading the
+    whole file at once.
+    """
+    with open(file_path, encoding="utf-8") as f:
+        for chunk in f:
+            # Reading by line only splits on newlines, splitlines() also splits on the other line boundaries
+            for line in chunk.splitlines():
+                if len(line) > 0 and not line.isspace():
+                    yield line
+
+
+def build_token_file(
+    tokenizer: PreTrainedTokenizer,
+    corpora: Dict[str, Iterable[str]],
+    prefix: str,
+    line_by_line: bool = True,
+    batch_size: int = 1000,
+):
+    """
+    Tokenize corpora once into a token file that MemmapTokenDataset reads with a memory map:
+    - prefix.bin: token ids, as uint16 if the vocabulary fits, uint32 otherwise
+    - prefix.offsets.npy: position of the first token of each sequence, and the total number of tokens
+    - prefix.json: dtype, vocabulary size, mode and the range of sequences of each corpus
+
+    With line_by_line, each string of a corpus is a line, tokenized like LineByLineTextDataset without special
+    tokens; lines are tokenized in batches and written as they go. Otherwise the strings of a corpus are joined
+    as they are and tokenized as one text, like TextDataset tokenizes a file, so pass the text of a file, or
+    lines ending with "\n". Several corpora, e.g. the tweets of each handle, share the same file.
+    """
+    dtype = np.uint16 if len(tokenizer) <= np.iinfo(np.uint16).max + 1 else np.uint32
+    offsets = [0]
+    index = {}
+
+    with open(prefix + ".bin.tmp", "wb") as f:
+        for name, lines in corpora.items():
+            first = len(offsets) - 1
+            if line_by_line:
+                batch = []
+                for line in lines:
+                    batch.append(line)
+                    if len(batch) == batch_size:
+                        _write_sequences(tokenizer.batch_encode_plus(batch, add_special_tokens=False)["input_ids"],
+                                         dtype, f, offsets)
+                        batch = []
+                if batch:
+                    _write_sequences(tokenizer.batch_encode_plus(batch, add_special_tokens=False)["input_ids"],
+                                     dtype, f, offsets)
+            else:
+                # Same tokenization as TextDataset
+                text = "".join(lines)
+                _write_sequences([tokenizer.convert_tokens_to_ids(tokenizer.tokenize(text))], dtype, f, offsets)
+            index[name] = [first, len(offsets) - 1]
+            logger.info("Tokenized %s: %d tokens", name, offsets[-1] - offsets[first])
+
+    np.save(prefix + ".offsets.tmp.npy", np.array(offsets, dtype=np.int64))
+    with open(prefix + ".json.tmp", "w") as f:
+        json.dump(
+            {
+                "dtype": np.dtype(dtype).name,
+                "vocab_size": len(tokenizer),
+                "line_by_line": line_by_line,
+                "corpora": index,
+            },
+            f,
+        )
+    # The index is renamed last, so a file is only used once it's complete
+    os.replace(prefix + ".bin.tmp", prefix + ".bin")
+    os.replace(prefix + ".offsets.tmp.npy", prefix + ".offsets.npy")
+    os.replace(prefix + ".json.tmp", prefix + ".json")
+
+
+def _write_sequences(sequences, dtype, f, offsets):
+    ids = np.fromiter(
+        (token for ids in sequences for token in ids), dtype=dtype, count=sum(len(ids) for ids in sequences)
+    )
+    f.write(ids.tobytes())
+    for ids in sequences:
+        offsets.append(offsets[-1] + len(ids))
+
+
+class MemmapTokenDataset(Dataset):
+    """
+    Dataset over a token file written by build_token_file(), read with a memory map so that only the sequences
+    of a batch are loaded. With line_by_line, each line is a sequence truncated to block_size, as in
+    LineByLineTextDataset. Otherwise the tokens of each corpus are split into blocks of block_size tokens, as
+    TextDataset does with the text file; blocks don't cross corpora. The file must have been built with the
+    same line_by_line.
+    """
+
+    def __init__(
+        self,
+        tokenizer: PreTrainedTokenizer,
+        prefix: str,
+        block_size: int,
+        line_by_line: bool = False,
+        corpora: Optional[List[str]] = None,
+    ):
+        with open(prefix + ".json") as f:
+            index = json.load(f)
+        if index["vocab_size"] != len(tokenizer):
+            raise ValueError(
+                f"Token file {prefix} was built with a vocabulary of {index['vocab_size']} tokens, "
+                f"the tokenizer has {len(tokenizer)}. Rebuild it with --overwrite_cache."
+            )
+        if index.get("line_by_line") != line_by_line:
+            raise ValueError(
+                f"Token file {prefix} was built with line_by_line={index.get('line_by_line')}. "
+                "Rebuild it with --overwrite_cache."
+            )
+        corpora = corpora or list(index["corpora"])
+        missing = [name for name in corpora if name not in index["corpora"]]
+        if missing:
+            raise ValueError(f"Corpora not in token file {prefix}: {', '.join(missing)}")
+
+        self.tokenizer = tokenizer
+        self.prefix = prefix
+        self.dtype = np.dtype(index["dtype"])
+        self.line_by_line = line_by_line
+        self.offsets = np.load(prefix + ".offsets.npy", mmap_mode="r")
+        self.ids = None
+
+        ranges = [index["corpora"][name] for name in corpora]
+        self.block_size = block_size - tokenizer.num_special_tokens_to_add(pair=False)
+        if line_by_line:
+            self.lines = np.concatenate([np.arange(first, last) for first, last in ranges])
+            # Position of the first line of each corpus
+            self.corpus_starts = np.cumsum([0] + [last - first for first, last in ranges[:-1]])
+        else:
+            # Position of the first token of each block
+            self.starts = np.concatenate(
+                [
+                    np.arange(
+                        self.offsets[first], self.offsets[last] - self.block_size + 1, self.block_size, dtype=np.int64
+                    )
+                    for first, last in ranges
+                ]
+            )
+
+    def __getstate__(self):
+        # Worker processes open their own memory map
+        state = self.__dict__.copy()
+        state["ids"] = None
+        return state
+
+    def __len__(self):
+        return len(self.lines) if self.line_by_line else len(self.starts)
+
+    def lengths(self) -> np.ndarray:
+        """
+        Length of each sequence, read from the offsets without loading the tokens.
+        """
+        n_special = self.tokenizer.num_special_tokens_to_add(pair=False)
+        if self.line_by_line:
+            lengths = self.offsets[self.lines + 1] - self.offsets[self.lines]
+            return np.minimum(lengths, self.block_size) + n_special
+        return np.full(len(self.starts), self.block_size + n_special)
+
+    def __getitem__(self, i) -> torch.Tensor:
+        if self.ids is None:
+            self.ids = np.memmap(self.prefix + ".bin", dtype=self.dtype, mode="r")
+        if self.line_by_line:
+            line = self.lines[i]
+            start = self.offsets[line]
+            end = min(self.offsets[line + 1], start + self.block_size)
+        else:
+            start = self.starts[i]
+            end = start + self.block_size
+        block = self.ids[start:end].astype(np.int64).tolist()
+        return torch.tensor(self.tokenizer.build_inputs_with_special_tokens(block), dtype=torch.long)
+
+
+def dataset_lengths(dataset: Dataset) -> np.ndarray:
+    """
+    Length of each sequence of a dataset, without loading the sequences if the dataset knows them.
+    """
+    if hasattr(dataset, "lengths"):
+        return np.asarray(dataset.lengths())
+    if hasattr(dataset, "examples"):
+        return np.array([len(example) for example in dataset.examples])
+    return np.array([len(dataset[i]) for i in range(len(dataset))])
+
+
+class PackedDataset(Dataset):
+    """
+    Consecutive sequences of a line by line dataset concatenated into sequences of up to block_size tokens,
+    with separator tokens between them, so short tweets don't each take a padded row of a batch. If the dataset
+    has corpus_starts, like a MemmapTokenDataset of several handles, packing starts a new sequence at each
+    corpus, so a sequence never mixes the tweets of two handles.
+    """
+
+    def __init__(self, dataset: Dataset, block_size: int, separator: List[int]):
+        self.dataset = dataset
+        self.separator = torch.tensor(separator, dtype=torch.long)
+        lengths = dataset_lengths(dataset)
+        corpus_starts = set(getattr(dataset, "corpus_starts", []))
+
+        # Greedily fill each sequence in order, a sequence always gets at least one line
+        starts = [0]
+        self.sizes = []
+        size = 0
+        for i, length in enumerate(lengths):
+            added = length if i == starts[-1] else len(separator) + length
+            if i > starts[-1] and (size + added > block_size or i in corpus_starts):
+                self.sizes.append(size)
+                starts.append(i)
+                added = length
+                size = 0
+            size += added
+        if len(lengths):
+            self.sizes.append(size)
+        self.starts = np.array(starts[: len(self.sizes)] + [len(lengths)])
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def lengths(self) -> np.ndarray:
+        return np.array(self.sizes)
+
+    def __getitem__(self, i) -> torch.Tensor:
+        parts = []
+        for j in range(self.starts[i], self.starts[i + 1]):
+            if parts:
+                parts.append(self.separator)
+            parts.append(self.dataset[j])
+        return torch.cat(parts)
+
+
+class LengthGroupedBatchSampler(Sampler):
+    """
+    Batches of sequences of similar length. Sequences are shuffled, split into groups of mega_batch_factor
+    batches, sorted by length within each group and cut into batches, and the batches are shuffled, so batches
+    are still random but need little padding. Each iteration uses a new shuffle.
+    """
+
+    def __init__(
+        self, lengths: np.ndarray, batch_size: int, mega_batch_factor: int = 50, seed: int = 42, drop_last=False
+    ):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.mega_batch_size = batch_size * mega_batch_factor
+        self.seed = seed
+        self.drop_last = drop_last
+        self.epoch = 0
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.lengths) // self.batch_size
+        return math.ceil(len(self.lengths) / self.batch_size)
+
+    def __iter__(self) -> Iterator[List[int]]:
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        self.epoch += 1
+
+        indices = torch.randperm(len(self.lengths), generator=generator).numpy()
+        batches = []
+        for start in range(0, len(indices), self.mega_batch_size):
+            group = indices[start : start + self.mega_batch_size]
+            group = group[np.argsort(-self.lengths[group], kind="stable")]
+            batches.extend(group[i : i + self.batch_size] for i in range(0, len(group), self.batch_size))
+        if self.drop_last and batches and len(batches[-1]) < self.batch_size:
+            batches.pop()
+
+        for i in torch.randperm(len(batches), generator=generator).tolist():
+            yield batches[i].tolist()
+
+
+@dataclass
+class DataCollatorForDynamicPadding:
+    """
+    Causal language modeling batches padded only to the longest sequence of the batch. GPT-2 has no padding
+    token, so sequences are padded with the end of sequence token, and padding is left out of the attention
+    and of the loss (label -100).
+    """
+
+    tokenizer: PreTrainedTokenizer
+
+    def __call__(self, examples: List[torch.Tensor]) -> Dict[str, torch.Tensor]:
+        pad_token_id = self.tokenizer.pad_token_id
+        if pad_token_id is None:
+            pad_token_id = self.tokenizer.eos_token_id
+        lengths = torch.tensor([len(example) for example in examples])
+        input_ids = pad_sequence(examples, batch_first=True, padding_value=pad_token_id)
+        attention_mask = torch.arange(input_ids.shape[1])[None, :] < lengths[:, None]
+        labels = input_ids.masked_fill(~attention_mask, -100)
+        return {"input_ids": input_ids, "attention_mask": attention_mask.long(), "labels": labels}
+
+    # Name of the collate method of DataCollator in older versions of the Trainer
+    collate_batch = __call__
+
+
+class LengthGroupedTrainer(Trainer):
+    """
+    Trainer whose training batches come from LengthGroupedBatchSampler.
+    """
+
+    def get_train_dataloader(self) -> DataLoader:
+        if self.args.local_rank != -1:
+            # Distributed training keeps the distributed sampler
+            return super().get_train_dataloader()
+        batch_sampler = LengthGroupedBatchSampler(
+            dataset_lengths(self.train_dataset),
+            self.args.train_batch_size,
+            seed=self.args.seed,
+            drop_last=getattr(self.args, "dataloader_drop_last", False),
+        )
+        return DataLoader(self.train_dataset, batch_sampler=batch_sampler, collate_fn=self.data_collator)
 
 
 def get_dataset(args: DataTrainingArguments, tokenizer: PreTrainedTokenizer, evaluate=False):
     file_path = args.eval_data_file if evaluate else args.train_data_file
+    token_file = args.eval_token_file if evaluate else args.train_token_file
+    if token_file:
+        if not os.path.exists(token_file + ".json") and file_path is None:
+            raise ValueError(
+                f"Token file {token_file} doesn't exist. Build it with build_token_file() or pass the text file "
+                f"to build it from with --{'eval' if evaluate else 'train'}_data_file."
+            )
+        if file_path is not None and (args.overwrite_cache or not os.path.exists(token_file + ".json")):
+            name = os.path.splitext(os.path.basename(file_path))[0]
+            if args.line_by_line:
+                corpus = read_lines(file_path)
+            else:
+                with open(file_path, encoding="utf-8") as f:
+                    corpus = [f.read()]
+            build_token_file(tokenizer, {name: corpus}, token_file, line_by_line=args.line_by_line)
+        corpora = args.corpora.split(",") if args.corpora else None
+        return MemmapTokenDataset(
+            tokenizer, token_file, block_size=args.block_size, line_by_line=args.line_by_line, corpora=corpora
+        )
     if args.line_by_line:
         return LineByLineTextDataset(tokenizer=tokenizer, file_path=file_path, block_size=args.block_size)
     else:
@@ -135,6 +504,61 @@ def get_dataset(args: DataTrainingArguments, tokenizer: PreTrainedTokenizer, eva
         )
 
 
+def benchmark_batching(model, tokenizer: PreTrainedTokenizer, dataset: Dataset, block_size: int, batch_size=8,
+                       max_batches=50, seed=42):
+    """
+    Compare random batches padded to their longest sequence, the batches of the stock collator, with
+    length grouped batches and packed lines, on a line by line dataset. Each batch runs a forward and backward
+    pass of the model.
+
+    Returns:
+        dict
+            Tokens (excluding padding) per second and share of padding tokens of each mode
+    """
+    collator = DataCollatorForDynamicPadding(tokenizer)
+    separator = [tokenizer.eos_token_id if tokenizer.eos_token_id is not None else tokenizer.sep_token_id]
+    packed = PackedDataset(dataset, block_size, separator)
+    generator = torch.Generator()
+    generator.manual_seed(seed)
+    modes = {
+        "random": DataLoader(
+            dataset, batch_size=batch_size, sampler=RandomSampler(dataset, generator=generator), collate_fn=collator
+        ),
+        "grouped": DataLoader(
+            dataset,
+            batch_sampler=LengthGroupedBatchSampler(dataset_lengths(dataset), batch_size, seed=seed),
+            collate_fn=collator,
+        ),
+        "packed": DataLoader(
+            packed, batch_size=batch_size, sampler=RandomSampler(packed, generator=generator), collate_fn=collator
+        ),
+    }
+
+    model.train()
+    results = {}
+    for mode, loader in modes.items():
+        tokens = padding = 0
+        t = time.time()
+        for i, batch in enumerate(loader):
+            if i == max_batches:
+                break
+            model.zero_grad()
+            model(**batch)[0].backward()
+            n_tokens = int(batch["attention_mask"].sum())
+            tokens += n_tokens
+            padding += batch["attention_mask"].numel() - n_tokens
+        results[mode] = {"tokens_per_sec": tokens / (time.time() - t), "padding_ratio": padding / (tokens + padding)}
+        logger.info(
+            "%s: %.0f tokens/sec, %.1f%% padding",
+            mode,
+            results[mode]["tokens_per_sec"],
+            100 * results[mode]["padding_ratio"],
+        )
+    model.zero_grad()
+
+    return results
+
+
 def main():
     # See all possible arguments in src/transformers/training_args.py
     # or by passing the --help flag to this script.
@@ -221,6 +645,9 @@ def main():
             "--mlm flag (masked language modeling)."
         )
 
+    if (data_args.bucket_by_length or data_args.pack_lines) and (data_args.mlm or not data_args.line_by_line):
+        raise ValueError("--bucket_by_length and --pack_lines are for causal language modeling with --line_by_line.")
+
     if data_args.block_size <= 0:
         data_args.block_size = tokenizer.max_len
         # Our input block size will be the max possible for the model
@@ -231,7 +658,17 @@ def main():
 
     train_dataset = get_dataset(data_args, tokenizer=tokenizer) if training_args.do_train else None
     eval_dataset = get_dataset(data_args, tokenizer=tokenizer, evaluate=True) if training_args.do_eval else None
-    if config.model_type == "xlnet":
+    if data_args.pack_lines:
+        separator = [tokenizer.eos_token_id if tokenizer.eos_token_id is not None else tokenizer.sep_token_id]
+        if separator[0] is None:
+            raise ValueError("--pack_lines needs a tokenizer with an end of sequence or separator token.")
+        if train_dataset is not None:
+            train_dataset = PackedDataset(train_dataset, data_args.block_size, separator)
+        if eval_dataset is not None:
+            eval_dataset = PackedDataset(eval_dataset, data_args.block_size, separator)
+    if data_args.bucket_by_length or data_args.pack_lines:
+        data_collator = DataCollatorForDynamicPadding(tokenizer=tokenizer)
+    elif config.model_type == "xlnet":
         #data_collator = DataCollatorForPermutationLanguageModeling(
         #    tokenizer=tokenizer, plm_probability=data_args.plm_probability, max_span_length=data_args.max_span_length,
         #)
@@ -242,7 +679,8 @@ def main():
         )
 
     # Initialize our Trainer
-    trainer = Trainer(
+    trainer_class = LengthGroupedTrainer if data_args.bucket_by_length else Trainer
+    trainer = trainer_class(
         model=model,
         args=training_args,
         data_collator=data_collator,